@@ -5,18 +5,128 @@
 import codecs
 import collections
 import datetime
+import functools
+import io
+import itertools
 import operator
+import Queue
 import re
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
 from evelink import api, eve
-from evelink.cache.sqlite import SqliteCache
-import sys, os, tempfile, time, json, urllib2, urllib
+import ChatLogWatcher
+import KosCache
+import KosHttp
+import KosIndex
+import KosStats
+import sys, os, tempfile, time, json, urllib
+
+try:
+  from scandir import scandir
+except ImportError:
+  scandir = getattr(os, 'scandir', None)
 
 KOS_CHECKER_URL = 'http://kos.cva-eve.org/api/?c=json&type=unit&%s'
 NPC = 'npc'
 LASTCORP = 'lastcorp'
+KOS = 'kos'
+NOTKOS = 'notkos'
+VERDICT_KEY = 'koscheck/verdict'
+CORP_VERDICT_KEY = 'koscheck/corp'
+# How long a verdict is remembered, by kind of verdict. NPC only applies
+# to the corps in a pilot's employment history.
+VERDICT_TTLS = {
+    KOS: 60*60,
+    LASTCORP: 30*60,
+    NOTKOS: 15*60,
+    NPC: 24*60*60,
+}
+# How long after that a verdict is still shown, while it is rechecked in
+# the background.
+VERDICT_GRACE = {
+    KOS: 24*60*60,
+    LASTCORP: 6*60*60,
+    NOTKOS: 6*60*60,
+    NPC: 7*24*60*60,
+}
+# The same for the KOS site's answers, by what they say about the name.
+KOS_TTLS = {
+    KOS: 60*60,
+    NOTKOS: 60*60,
+    NPC: 6*60*60,
+}
+KOS_GRACE = {
+    KOS: 24*60*60,
+    NOTKOS: 12*60*60,
+    NPC: 7*24*60*60,
+}
+# How many corps of an employment history are looked up ahead of the one
+# being examined.
+HISTORY_WINDOW = 4
+# How many pilots from a single log entry are checked at once.
+DEFAULT_WORKERS = 8
+# How many names are sent in a single eve/CharacterID request.
+ID_BATCH_SIZE = 100
+# Bytes read from a log at a time when catching up.
+READ_SIZE = 64 * 1024
+# How many names looked up on the KOS site are saved into the local index
+# at a time.
+INDEX_SAVE_EVERY = 200
+# Speakers waiting to be prefetched; more are dropped until there's room.
+PREFETCH_QUEUE = 1000
+# How many recent speakers are remembered so each is prefetched once.
+PREFETCH_REMEMBER = 5000
+# The speaker of game messages in chat logs, not a pilot.
+SYSTEM_SPEAKER = u'EVE System'
+# Logs kept open at once by a DirectoryTailer; the least recently active
+# are closed beyond that, and reopened where they left off when they grow.
+MAX_OPEN_LOGS = 32
+# Logs written within this long of the newest are watched; older ones
+# have been rotated out by the client, and are forgotten.
+LOG_WINDOW = 24*60*60
+# Closed logs are checked for growth once per wakeup of the notifier, or
+# at least this often in seconds, rather than on every poll.
+REOPEN_CHECK_INTERVAL = 1.0
+# How long after the (UTC) time in its name a log can still be written to;
+# the daily downtime ends every session.
+LOG_SESSION = 24*60*60
+# The start time in log names, e.g. Fleet_20120729_002356.txt, or with the
+# listener's character ID after it in newer clients.
+LOG_NAME = re.compile(r'_(\d{8}_\d{6})(?:_\d+)?\.txt$')
+
+REPORT_TAGS = ('xxx', 'fff')
 
 Entry = collections.namedtuple('Entry', 'pilots comment linekey')
 
+def parse_timestamp(logdate, logtime):
+  """Parses a chat log '2012.07.29', '00:23:56' pair into a datetime.
+
+  Much cheaper than datetime.strptime, which matters when catching up.
+  """
+  year, month, day = logdate.split('.')
+  hour, minute, second = logtime.split(':')
+  return datetime.datetime(int(year), int(month), int(day),
+                           int(hour), int(minute), int(second))
+
+
+def clean_pilots(pilots):
+  """Drops blank names and trims stray spaces and dots from the rest."""
+  return [person.strip(' .') for person in pilots
+          if not person.isspace() and len(person) != 0]
+
+
+def verdict_class(kos):
+  """Classifies a koscheck reason as KOS, LASTCORP, NPC or NOTKOS."""
+  if not kos:
+    return NOTKOS
+  if kos == NPC:
+    return NPC
+  if kos.startswith(LASTCORP + ':'):
+    return LASTCORP
+  return KOS
+
+
 class FileTailer:
   MATCH = re.compile(
       # each line starts with a byte order marker
@@ -31,50 +141,140 @@ class FileTailer:
       ur'(?:#(?P<comment>.*))?',
       re.IGNORECASE)
 
-  def __init__(self, filename, encoding='utf-16'):
+  def __init__(self, filename, encoding='utf-16', from_start=False,
+               stats=KosStats.DISABLED, on_speaker=None, lazy=False):
     self.filename = filename
-    self.handle = codecs.open(filename, 'rb', encoding)
+    self.encoding = encoding
+    self.stats = stats
+    # Called with the name of everyone who says anything, e.g. to prefetch.
+    self.on_speaker = on_speaker
+    # Decoded text after the last newline, waiting for the rest of its line.
+    self.partial = u''
+    self.lines = collections.deque()
+    # The date of the last report returned, as written in the log, since
+    # its linekey only has the time.
+    self.last_date = None
+    # Set up once the file is first opened.
+    self.decoder = None
 
-    # seek to the end
-    fstat = os.fstat(self.handle.fileno())
-    self.handle.seek(fstat.st_size)
+    # A lazy tailer isn't opened until resume(), e.g. once the log grows.
+    if lazy:
+      self.handle = None
+      fstat = os.stat(filename)
+    else:
+      self.handle = io.open(filename, 'rb', buffering=0)
+      fstat = os.fstat(self.handle.fileno())
+    # seek to the end, unless the whole log is wanted
+    self.offset = 0 if from_start else fstat.st_size
     self.mtime = fstat.st_mtime
+    if self.handle:
+      self._start()
+
+  def resume_encoding(self, encoding):
+    """Picks the byte order a utf-16 log was written in from its BOM."""
+    if codecs.lookup(encoding).name != 'utf-16':
+      return encoding
+    if self.handle.read(2) == codecs.BOM_UTF16_BE:
+      return 'utf-16-be'
+    return 'utf-16-le'
 
   def close(self):
-    self.handle.close()
+    if self.handle:
+      self.handle.close()
+      self.handle = None
 
-  def poll(self):
-    fstat = os.fstat(self.handle.fileno())
-    size = fstat.st_size
+  def is_open(self):
+    return self.handle is not None
+
+  def suspend(self):
+    """Closes the file, remembering where to carry on from."""
+    self.close()
+
+  def resume(self):
+    """Reopens a suspended file at the offset it was closed at."""
+    # Unbuffered, so reads past a previous end of file see new data.
+    self.handle = io.open(self.filename, 'rb', buffering=0)
+    self._start()
+
+  def _start(self):
+    if self.decoder is None:
+      encoding = self.encoding
+      if self.offset:
+        # The BOM is behind us, and the utf-16 decoder insists on seeing one.
+        encoding = self.resume_encoding(encoding)
+      self.decoder = codecs.getincrementaldecoder(encoding)()
+    self.handle.seek(self.offset)
+
+  def changed(self):
+    """Whether a suspended file has grown, without opening it.
+
+    Raises OSError if the file is gone.
+    """
+    if self.lines:
+      # Closed with lines still to check.
+      return True
+    fstat = os.stat(self.filename)
     self.mtime = fstat.st_mtime
-    where = self.handle.tell()
-    while size > where:
-      try:
-        line = self.handle.readline()
-      except UnicodeError:
-        self.close()
-        raise
-      where = self.handle.tell()
+    return fstat.st_size > self.offset
 
-      answer = self.check(line)
-      if answer:
-        return answer
+  def poll(self):
+    with self.stats.timer('tail'):
+      while True:
+        while self.lines:
+          answer = self.check(self.lines.popleft())
+          if answer:
+            return answer
+        if not self.read_lines():
+          return None
 
-    return None
+  def read_lines(self):
+    """Decodes newly appended bytes into complete lines.
+
+    A trailing partial line is held back until the rest of it is written.
+
+    @returns: False if there was nothing new to read.
+    """
+    fstat = os.fstat(self.handle.fileno())
+    self.mtime = fstat.st_mtime
+    if fstat.st_size <= self.offset:
+      return False
+    data = self.handle.read(READ_SIZE)
+    if not data:
+      return False
+    self.offset += len(data)
+    try:
+      text = self.decoder.decode(data)
+    except UnicodeError:
+      self.close()
+      raise
+    lines = (self.partial + text).split(u'\n')
+    self.partial = lines.pop()
+    self.lines.extend(line + u'\n' for line in lines)
+    return True
 
   def last_update(self):
     return self.mtime
 
   def check(self, line):
+    # Nearly every line is ordinary chat, so reject anything whose message
+    # doesn't start with a report tag before running the full regex. Pilot
+    # names can't contain '>', so the first ' > ' ends the header.
+    sep = line.find(u' > ')
+    if sep < 0:
+      return None
+    if self.on_speaker:
+      start = line.find(u'] ', 0, sep)
+      if start >= 0 and line[start + 2:sep] != SYSTEM_SPEAKER:
+        self.on_speaker(line[start + 2:sep])
+    if line[sep + 3:sep + 6].lower() not in REPORT_TAGS:
+      return None
     m = self.MATCH.match(line)
     if not m:
       return None
 
     logdate = m.group('date')
     logtime = m.group('time')
-    timestamp = datetime.datetime.strptime(
-        '{} {}'.format(logdate, logtime),
-        '%Y.%m.%d %H:%M:%S')
+    timestamp = parse_timestamp(logdate, logtime)
     pilot = m.group('pilot')
     names = m.group('names').replace('  ', '\n')
     names = tuple(n.strip() for n in names.splitlines())
@@ -86,74 +286,335 @@ class FileTailer:
       comment = '[%s] %s >' % (logtime, pilot)
 
     linekey = (timestamp.hour, timestamp.minute, pilot, names, suffix)
+    self.last_date = logdate
     return Entry(names, comment, linekey)
 
 
+def list_dir(path):
+  """Returns (name, entry) for each file in path.
+
+  entry is a scandir DirEntry, whose stat() on Windows comes from the
+  directory listing itself rather than asking for each file, or None if
+  scandir isn't available.
+  """
+  if scandir:
+    return [(entry.name, entry) for entry in scandir(path)]
+  return [(name, None) for name in os.listdir(path)]
+
+
 class DirectoryTailer:
-  def __init__(self, path):
+  """Tails every recently written log in a directory.
+
+  Logs are only opened once they grow after the directory is scanned, and
+  a log whose name says it was started too long ago to have been written
+  to recently is skipped without even a stat.
+
+  At most max_open logs are kept open. Beyond that the least recently
+  active are closed, then reopened at the same offset once they grow.
+  Logs that fall LOG_WINDOW behind the newest, or disappear, are
+  forgotten. The stats count 'tail_opened', 'tail_closed',
+  'tail_reopened' and 'tail_evicted'; counts() gives the current numbers.
+  """
+
+  def __init__(self, path, notifier=None, stats=KosStats.DISABLED,
+               on_speaker=None, max_open=MAX_OPEN_LOGS):
     self.path = path
-    self.watchers = {}
+    self.stats = stats
+    self.on_speaker = on_speaker
+    self.max_open = max_open
+    # Filename -> FileTailer, least recently active first.
+    self.watchers = collections.OrderedDict()
     self.mtime = 0
+    # Whether closed logs are due a check; see REOPEN_CHECK_INTERVAL.
+    self.woken = True
+    self.checked = 0.0
+    self.notifier = notifier or ChatLogWatcher.create_watcher(path)
+    self.event_driven = self.notifier.event_driven
 
     for _answer in iter(self.poll, None):
       pass
 
+  def wait(self, timeout=None):
+    """Blocks until a log may have been written to; see ChatLogWatcher."""
+    woken = self.notifier.wait(timeout)
+    if woken:
+      self.woken = True
+    return woken
+
+  def close(self):
+    self.notifier.close()
+    for watcher in self.watchers.itervalues():
+      watcher.close()
+    self.watchers = {}
+
   def last_update(self):
     if self.watchers:
       return max(w.last_update() for w in self.watchers.itervalues())
     else:
       return None
 
+  def counts(self):
+    """Returns how many logs are watched, and how many of those are open."""
+    is_open = [w.is_open() for w in self.watchers.itervalues()]
+    return {'watched': len(is_open), 'open': sum(is_open)}
+
   def poll(self):
     st_mtime = os.stat(self.path).st_mtime
     if st_mtime != self.mtime:
       self.mtime = st_mtime
-      for name in os.listdir(self.path):
-        filename = os.path.join(self.path, name)
-        if filename in self.watchers:
-          continue
-        # anything within a day.
-        if abs(self.mtime - os.stat(filename).st_mtime) < 86400:
-          self.watchers[filename] = FileTailer(filename)
+      with self.stats.timer('tail_scan'):
+        self._scan()
+    now = time.time()
+    if self.woken or now - self.checked >= REOPEN_CHECK_INTERVAL:
+      self.woken = False
+      self.checked = now
+      self._reopen_changed()
 
     for filename, watcher in self.watchers.items():
+      if not watcher.is_open():
+        continue
+      offset = watcher.offset
       try:
-        for answer in iter(watcher.poll, None):
-          return answer
+        answer = watcher.poll()
       except UnicodeError:
         del self.watchers[filename]
+        continue
+      if watcher.offset != offset:
+        self._touch(filename)
+      if answer:
+        return answer
     return None
 
+  def _scan(self):
+    # Logs named as started before this are too old to be in the window,
+    # which is most of them, so they are passed over as cheaply as possible.
+    oldest = time.strftime('%Y%m%d_%H%M%S', time.gmtime(
+        self.mtime - LOG_WINDOW - LOG_SESSION))
+    search = LOG_NAME.search
+    prefix = os.path.join(self.path, '')
+    listed = set()
+    for name, entry in list_dir(self.path):
+      started = search(name)
+      if started and started.group(1) < oldest:
+        continue
+      filename = prefix + name
+      listed.add(filename)
+      if filename in self.watchers:
+        continue
+      fstat = entry.stat() if entry else os.stat(filename)
+      if abs(self.mtime - fstat.st_mtime) < LOG_WINDOW:
+        self.watchers[filename] = FileTailer(
+            filename, stats=self.stats, on_speaker=self.on_speaker, lazy=True)
+    for filename, watcher in self.watchers.items():
+      if filename not in listed or self.mtime - watcher.mtime >= LOG_WINDOW:
+        self._evict(filename)
+
+  def _reopen_changed(self):
+    for filename, watcher in self.watchers.items():
+      if watcher.is_open():
+        continue
+      opened = watcher.decoder is not None
+      try:
+        if not watcher.changed():
+          continue
+        watcher.resume()
+      except (IOError, OSError):
+        self._evict(filename)
+        continue
+      self.stats.increment('tail_reopened' if opened else 'tail_opened')
+      self._touch(filename)
+      self._limit_open(filename)
+
+  def _touch(self, filename):
+    """Marks a log as the most recently active."""
+    self.watchers[filename] = self.watchers.pop(filename)
+
+  def _limit_open(self, keep):
+    """Closes the least recently active logs beyond max_open, except keep."""
+    open_logs = [f for f, w in self.watchers.iteritems() if w.is_open()]
+    for filename in open_logs[:max(0, len(open_logs) - self.max_open)]:
+      if filename != keep:
+        self.watchers[filename].suspend()
+        self.stats.increment('tail_closed')
+        # It may have been closed part way through, so look again next poll.
+        self.woken = True
+
+  def _evict(self, filename):
+    self.watchers.pop(filename).close()
+    self.stats.increment('tail_evicted')
+
+
+class PooledAPI(api.API):
+  """An api.API that sends its requests through a KosHttp.HttpPool.
+
+  With plain_http, requests go over http rather than https, e.g. to a
+  local server.
+  """
+
+  def __init__(self, http, plain_http=False, **kwargs):
+    api.API.__init__(self, **kwargs)
+    self.http = http
+    self.plain_http = plain_http
+
+  def send_request(self, full_path, params):
+    if self.plain_http and full_path.startswith('https://'):
+      full_path = 'http://' + full_path[len('https://'):]
+    return io.BytesIO(self.http.request(full_path, params or None))
+
 
 class KosChecker:
   """Maintains API state and performs KOS checks."""
 
-  def __init__(self):
+  def __init__(self, max_workers=DEFAULT_WORKERS,
+               memory_size=KosCache.DEFAULT_MEMORY_SIZE, verdict_ttls=None,
+               verdict_grace=None, kos_ttls=None, kos_grace=None,
+               cache_file=None, kos_url=KOS_CHECKER_URL, api_base_url=None,
+               stats=KosStats.DISABLED, http=None, index_file=None):
+    # Timings of each lookup stage; see KosStats.
+    self.stats = stats
+    # Keep-alive connections shared by the KOS and EVE API requests, paced
+    # so background work can't get us rate limited.
+    self.http = http or KosHttp.HttpPool(
+        stats=stats, scheduler=KosHttp.Scheduler(stats=stats))
+
     # Set up caching.
-    cache_file = os.path.join(tempfile.gettempdir(), 'koscheck')
-    self.cache = SqliteCache(cache_file)
+    if cache_file is None:
+      cache_file = os.path.join(tempfile.gettempdir(), 'koscheck')
+    self.cache = KosCache.TieredCache(
+        KosCache.SharedSqliteCache(cache_file),
+        KosCache.MemoryCache(memory_size), stats)
 
-    self.api = api.API(cache=self.cache)
+    # Local snapshot of the KOS site, answered from before going online.
+    if index_file is None:
+      index_file = cache_file + '.idx'
+    try:
+      self.index = KosIndex.KosIndex(index_file)
+    except ValueError as e:
+      # Rebuilt from the site's answers at the next save.
+      print >>sys.stderr, 'Ignoring the KOS index: %s' % e
+      self.index = KosIndex.KosIndex(index_file, load=False)
+    # Lower-cased name -> units from the KOS site, not yet in the index.
+    self.learned = {}
+    self.learned_lock = threading.Lock()
+    # Saves run from the refresh pool and at exit; one at a time.
+    self.save_lock = threading.Lock()
+    # Background index refreshes and saves, one at a time.
+    self.refresh_pool = None
+    self.refreshing = set()
+
+    self.kos_url = kos_url
+    if api_base_url is None:
+      self.api = PooledAPI(self.http, cache=self.cache)
+    elif api_base_url.startswith('http://'):
+      self.api = PooledAPI(self.http, plain_http=True,
+                           base_url=api_base_url[len('http://'):],
+                           cache=self.cache)
+    else:
+      self.api = PooledAPI(self.http, base_url=api_base_url, cache=self.cache)
     self.eve = eve.EVE(api=self.api)
 
-  def koscheck(self, player):
-    """Checks a given player against the KOS list, including esoteric rules."""
-    kos = self.koscheck_internal(player)
-    cid = self.eve.character_id_from_name(player)
+    self.max_workers = max(1, max_workers)
+    self.pool = None
+    # Employment history lookups get their own pool, as they are started
+    # from inside tasks running on self.pool.
+    self.history_pool = None
+    # Held while starting either pool, which the first lookup needing it does.
+    self.pool_lock = threading.Lock()
+    # Shares lookups already in progress, keyed by their cache key.
+    self.inflight = KosCache.SingleFlight(stats)
+    # Lower-cased name -> character ID, filled in by batch lookups.
+    self.character_ids = {}
+    self.verdict_ttls = dict(VERDICT_TTLS)
+    self.verdict_ttls.update(verdict_ttls or {})
+    self.verdict_grace = dict(VERDICT_GRACE)
+    self.verdict_grace.update(verdict_grace or {})
+    self.kos_ttls = dict(KOS_TTLS)
+    self.kos_ttls.update(kos_ttls or {})
+    self.kos_grace = dict(KOS_GRACE)
+    self.kos_grace.update(kos_grace or {})
+
+  def remember_character_ids(self, mapping):
+    """Records already known name -> ID pairs, e.g. from a contact list."""
+    for name, cid in mapping.iteritems():
+      self.character_ids[name.lower()] = cid
+
+  def character_ids_from_names(self, names):
+    """Resolves many names to IDs using as few API requests as possible.
+
+    @returns: A dict of name -> ID, None for names the API doesn't know.
+    """
+    missing = []
+    for name in names:
+      if name.lower() not in self.character_ids and name not in missing:
+        missing.append(name)
+    for start in range(0, len(missing), ID_BATCH_SIZE):
+      batch = missing[start:start + ID_BATCH_SIZE]
+      with self.stats.timer('character_ids'):
+        self.remember_character_ids(self.eve.character_ids_from_names(batch))
+    return dict((name, self.character_ids.get(name.lower())) for name in names)
+
+  def character_id(self, player):
+    return self.character_ids_from_names([player])[player]
+
+  def koscheck(self, player, cid=None):
+    """Checks a given player against the KOS list, including esoteric rules.
+
+    cid may be passed in when the player's ID has already been resolved.
+    The final verdict is cached, so rechecking a pilot is a single lookup.
+    A verdict past its TTL but within its grace period is returned at
+    once while it is rechecked in the background.
+    """
+    cache_key = self.api._cache_key(VERDICT_KEY, {'pilot': player.lower()})
+    cached = self.cache.get_stamped(cache_key)
+    if cached is not None:
+      verdict, stale = cached
+      if stale:
+        self.stats.increment('verdict_stale')
+        self._revalidate(cache_key, self._koscheck_and_cache, player, cid,
+                         True)
+      else:
+        self.stats.increment('verdict_cache_hit')
+      return verdict
+    return self.inflight.do(cache_key, self._koscheck_and_cache,
+                            cache_key, player, cid)
+
+  def _koscheck_and_cache(self, cache_key, player, cid, fresh=False):
+    with self.stats.timer('koscheck'):
+      verdict, stale = self._koscheck_stamped(player, cid, fresh)
+    kind = verdict_class(verdict[0])
+    if stale:
+      # Left uncached, so the next sighting works it out again from what
+      # the background refresh of the stale answers fetched.
+      self.stats.increment('verdict_from_stale')
+    elif self.verdict_ttls[kind] > 0:
+      self.cache.put_stamped(cache_key, verdict, self.verdict_ttls[kind],
+                             self.verdict_grace[kind])
+    return verdict
+
+  def koscheck_uncached(self, player, cid=None, fresh=False):
+    """Works out a player's verdict without consulting the verdict cache.
+
+    With fresh, the KOS site is asked again rather than trusting stale or
+    index answers, as when a stale verdict is being replaced.
+    """
+    return self._koscheck_stamped(player, cid, fresh)[0]
+
+  def _koscheck_stamped(self, player, cid, fresh):
+    """koscheck_uncached, also returning whether stale answers were used."""
+    kos, stale = self.koscheck_internal_stamped(player, fresh)
+    if cid is None:
+      cid = self.character_id(player)
     if kos not in (None, NPC):
-      return kos, cid
+      return (kos, cid), stale
 
     # We were unable to find the player. Use employment history to
     # get their current corp and look that up. If it's an NPC corp,
     # we'll get bounced again.
-    history = self.employment_history(cid)
-
+    history = self.corp_history(cid)
     in_npc_corp = False
-    for corp in history:
-      kos = self.koscheck_internal(corp)
-      if kos != NPC:
-        break
-      in_npc_corp = True
+    if history:
+      in_npc_corp, kos, corp_stale = self._first_player_corp(history, fresh)
+      stale = stale or corp_stale
 
     if kos == NPC:
       kos = None
@@ -161,24 +622,130 @@ class KosChecker:
     if in_npc_corp and kos:
       kos = '%s: %s' % (LASTCORP, kos)
 
-    return kos, cid
+    return (kos, cid), stale
+
+  def first_player_corp(self, history, fresh=False):
+    """Finds the first corp in history that isn't an NPC corp.
+
+    Corps are looked up HISTORY_WINDOW at a time in parallel, but results
+    are used in history order. Lookups that haven't started by the time
+    the answer is known are skipped.
+
+    @returns: (whether an NPC corp was passed over, that corp's verdict),
+        where the verdict is NPC if every corp in history was an NPC corp.
+    """
+    return self._first_player_corp(history, fresh)[:2]
+
+  def _first_player_corp(self, history, fresh):
+    """first_player_corp, also returning whether stale answers were used."""
+    done = threading.Event()
+    def check(corp):
+      if done.is_set():
+        return None, False
+      return self._corp_koscheck(*corp, fresh=fresh)
+
+    # Each lookup returns a function that waits for and returns its result.
+    if self.max_workers == 1:
+      lookup = lambda corp: functools.partial(check, corp)
+    else:
+      with self.pool_lock:
+        if self.history_pool is None:
+          self.history_pool = ThreadPool(self.max_workers)
+      check = KosHttp.bind_priority(check)
+      lookup = lambda corp: self.history_pool.apply_async(check, (corp,)).get
 
-  def koscheck_internal(self, entity):
+    corps = iter(history)
+    pending = collections.deque()
+    in_npc_corp = False
+    kos = NPC
+    stale = False
+    try:
+      while True:
+        for corp in itertools.islice(corps, HISTORY_WINDOW - len(pending)):
+          pending.append(lookup(corp))
+        if not pending:
+          break
+        kos, corp_stale = pending.popleft()()
+        stale = stale or corp_stale
+        if kos != NPC:
+          break
+        in_npc_corp = True
+    finally:
+      done.set()
+    return in_npc_corp, kos, stale
+
+  def corp_koscheck(self, corp_id, name, fresh=False):
+    """koscheck_internal for a corp, cached by corp ID."""
+    return self._corp_koscheck(corp_id, name, fresh)[0]
+
+  def _corp_koscheck(self, corp_id, name, fresh):
+    """corp_koscheck, also returning whether stale answers were used."""
+    cache_key = self.api._cache_key(CORP_VERDICT_KEY, {'corp_id': corp_id})
+    if fresh:
+      return self._corp_koscheck_and_cache(cache_key, name, fresh)
+    cached = self.cache.get(cache_key)
+    if cached is not None:
+      return cached[0], False
+    return self.inflight.do(cache_key, self._corp_koscheck_and_cache,
+                            cache_key, name)
+
+  def _corp_koscheck_and_cache(self, cache_key, name, fresh=False):
+    kos, stale = self.koscheck_internal_stamped(name, fresh)
+    ttl = self.verdict_ttls[verdict_class(kos)]
+    # Like pilot verdicts, left uncached until the refreshed answer is in.
+    if ttl > 0 and not stale:
+      self.cache.put(cache_key, (kos,), ttl)
+    return kos, stale
+
+  def koscheck_internal(self, entity, fresh=False):
     """Looks up KOS entries by directly calling the CVA KOS API.
 
+    With fresh, the site is always asked, skipping cached and index answers.
+
     @returns: The reason this pilot is KOS.
     """
+    return self.koscheck_internal_stamped(entity, fresh)[0]
+
+  def koscheck_internal_stamped(self, entity, fresh=False):
+    """Like koscheck_internal, but returns (reason, whether it is stale).
+
+    An answer is stale when it came from a stale cache entry or the index,
+    either of which is being refreshed in the background.
+    """
     if entity.startswith('CCP '):
-      return 'CCP'
+      return 'CCP', False
 
-    cache_key = self.api._cache_key(KOS_CHECKER_URL, {'entity': entity})
+    cache_key = self.api._cache_key(self.kos_url, {'entity': entity})
 
-    result = self.cache.get(cache_key)
-    if not result:
-      result = json.load(urllib2.urlopen(
-          KOS_CHECKER_URL % urllib.urlencode({'q' : entity})))
-      self.cache.put(cache_key, result, 60*60)
+    cached = None
+    stale = False
+    if not fresh:
+      with self.stats.timer('kos_cache'):
+        cached = self.cache.get_stamped(cache_key)
+    if cached:
+      result, stale = cached
+      if stale:
+        # Serve the old answer; it is almost always still right.
+        self.stats.increment('kos_stale')
+        self._revalidate(cache_key, self._fetch_kos, entity)
+    else:
+      units = None if fresh else self.index.find(entity)
+      if units:
+        # The index may be weeks old, so treat it like a stale entry.
+        self.stats.increment('kos_index')
+        self._revalidate(cache_key, self._fetch_kos, entity)
+        result = {'results': units}
+        stale = True
+      else:
+        result = self.inflight.do(cache_key, self._fetch_kos, cache_key,
+                                  entity)
+    return self.kos_reason(entity, result), stale
+
+  def kos_reason(self, entity, result):
+    """Reads why entity is KOS from a KOS site answer.
 
+    @returns: The reason, NPC for pilots in an NPC corp, or None.
+    """
     for value in result['results']:
       # Require exact match (case-insensitively).
       if value['label'].lower() != entity.lower():
@@ -200,53 +767,423 @@ class KosChecker:
         else:
           return
 
+  def _fetch_kos(self, cache_key, entity):
+    with self.stats.timer('kos_http'):
+      result = json.loads(self.http.request(
+          self.kos_url % urllib.urlencode({'q' : entity})))
+    kind = verdict_class(self.kos_reason(entity, result))
+    self.cache.put_stamped(cache_key, result, self.kos_ttls[kind],
+                           self.kos_grace[kind])
+    self._learn(entity, result['results'])
+    return result
+
+  def _background(self, func, *args):
+    with self.learned_lock:
+      if self.refresh_pool is None:
+        self.refresh_pool = ThreadPool(1)
+    self.refresh_pool.apply_async(func, args)
+
+  def _revalidate(self, cache_key, func, *args):
+    """Runs func(cache_key, *args) in the background to replace an entry.
+
+    Used for stale entries and index answers, so the lookup that found
+    them needn't wait.
+    """
+    with self.learned_lock:
+      if cache_key in self.refreshing:
+        return
+      self.refreshing.add(cache_key)
+    self._background(self._run_revalidation, cache_key, func, args)
+
+  def _run_revalidation(self, cache_key, func, args):
+    try:
+      with KosHttp.priority(KosHttp.BACKGROUND):
+        self.inflight.do(cache_key, func, cache_key, *args)
+    except Exception:
+      # The old answer stands until a later refresh gets through.
+      self.stats.increment('revalidate_failed')
+    finally:
+      with self.learned_lock:
+        self.refreshing.discard(cache_key)
+
+  def _learn(self, entity, units):
+    with self.learned_lock:
+      self.learned[entity.lower()] = units
+      full = len(self.learned) >= INDEX_SAVE_EVERY
+    if full:
+      self._background(self.save_index)
+
+  def save_index(self):
+    """Merges what has been looked up on the KOS site into the index."""
+    with self.save_lock:
+      with self.learned_lock:
+        learned, self.learned = self.learned, {}
+      if not learned:
+        return
+      try:
+        with self.stats.timer('index_save'):
+          # Names the site no longer knows are dropped, the rest overridden.
+          units = [unit for unit in self.index.units()
+                   if unit['label'].lower() not in learned]
+          for name in sorted(learned):
+            units.extend(learned[name])
+          self.index.replace(units)
+      except:
+        # Keep them for the next save, behind anything learned since.
+        with self.learned_lock:
+          for name, units in learned.iteritems():
+            self.learned.setdefault(name, units)
+        raise
+
   def employment_history(self, cid):
     """Retrieves a player's most recent corporations via EVE api."""
-    cdata = self.eve.character_info_from_id(cid)
-    corps = cdata['history']
-    unique_corps = []
-    for corp in corps:
-      if corp['corp_id'] not in unique_corps:
-        unique_corps.append(corp['corp_id'])
-    mapping = self.eve.character_names_from_ids(unique_corps)
-    return [mapping[cid] for cid in unique_corps]
-
-  def loop(self, filename, handler):
+    return [name for (corp_id, name) in self.corp_history(cid)]
+
+  def corp_history(self, cid):
+    """Like employment_history, but returns (corp ID, name) pairs."""
+    with self.stats.timer('employment_history'):
+      cdata = self.eve.character_info_from_id(cid)
+      corps = cdata['history']
+      unique_corps = []
+      for corp in corps:
+        if corp['corp_id'] not in unique_corps:
+          unique_corps.append(corp['corp_id'])
+      mapping = self.eve.character_names_from_ids(unique_corps)
+      return [(cid, mapping[cid]) for cid in unique_corps]
+
+  def loop(self, filename, handler, prefetch=False):
     """Performs KOS processing on each line read from the log file.
 
-    handler is a function of 3 args: (kos, notkos, error) that is called
-    every time there is a new KOS result.
+    handler is a function of 4 args: (comment, kos, notkos, error) that is
+    called every time there is a new KOS result. With prefetch, everyone
+    who speaks in the log is checked in the background ahead of time.
     """
-    tailer = FileTailer(filename)
+    on_speaker = Prefetcher(self).add if prefetch else None
+    tailer = FileTailer(filename, stats=self.stats, on_speaker=on_speaker)
     while True:
-      entry, comment = tailer.poll()
+      entry = tailer.poll()
       if not entry:
         time.sleep(1.0)
         continue
-      kos, not_kos, error = self.koscheck_logentry(entry)
-      handler(comment, kos, not_kos, error)
+      kos, not_kos, error = self.koscheck_logentry(entry.pilots)
+      handler(entry.comment, kos, not_kos, error)
+
+  def stream(self, path, out=None, prefetch=False):
+    """Writes JSON lines for each report in a log or log directory.
+
+    Runs forever; see JsonStream for the lines written to out (stdout by
+    default). With prefetch, speakers are checked ahead of time as in loop.
+    """
+    out = out or sys.stdout
+    on_speaker = Prefetcher(self).add if prefetch else None
+    if os.path.isdir(path):
+      tailer = DirectoryTailer(path, stats=self.stats, on_speaker=on_speaker)
+      notifier = tailer
+    else:
+      tailer = FileTailer(path, stats=self.stats, on_speaker=on_speaker)
+      notifier = ChatLogWatcher.create_watcher(
+          os.path.dirname(os.path.abspath(path)))
+    stream = JsonStream(self, out)
+    while True:
+      entry = tailer.poll()
+      if entry:
+        stream.submit(entry)
+      else:
+        notifier.wait(1.0)
+
+  def map(self, func, items):
+    """Applies func to every item using the worker pool.
+
+    Results are returned in the same order as items.
+    """
+    if self.max_workers == 1 or len(items) < 2:
+      return [func(item) for item in items]
+    with self.pool_lock:
+      if self.pool is None:
+        self.pool = ThreadPool(self.max_workers)
+    return self.pool.map(KosHttp.bind_priority(func), items)
+
+  def _koscheck_captured(self, args):
+    """Runs koscheck, returning (result, exc_info) instead of raising."""
+    person, cid = args
+    try:
+      return self.koscheck(person, cid), None
+    except:
+      return None, sys.exc_info()
+
+  def koscheck_pilots(self, people):
+    """Checks many pilots, resolving their IDs in bulk first.
+
+    @returns: A list of (result, exc_info) pairs in the order of people,
+        where result is koscheck's (reason, cid) or None on error.
+    """
+    try:
+      cids = self.character_ids_from_names(people)
+    except Exception:
+      # A single malformed name, or the EVE API being down, fails the
+      # whole batch, so fall back to resolving each pilot on its own; any
+      # errors then come back per pilot.
+      cids = {}
+    return self.map(self._koscheck_captured,
+                    [(person, cids.get(person)) for person in people])
 
   def koscheck_logentry(self, entry):
     kos = []
     notkos = []
     error = []
-    for person in entry:
-      if person.isspace() or len(person) == 0:
-        continue
-      person = person.strip(' .')
-      try:
-        reason, cid = self.koscheck(person)
-        if reason:
-          kos.append((person, reason, cid))
-        else:
-          notkos.append((person, cid))
-      except:
+    people = clean_pilots(entry)
+    results = self.koscheck_pilots(people)
+    for person, (result, exc_info) in zip(people, results):
+      if exc_info:
         error.append(person)
-        raise
+        raise exc_info[0], exc_info[1], exc_info[2]
+      reason, cid = result
+      if reason:
+        kos.append((person, reason, cid))
+      else:
+        notkos.append((person, cid))
     kos.sort(key=operator.itemgetter(1, 0))
     return (kos, notkos, error)
 
 
+class _EntryProgress:
+  """Collects the results for one entry as its pilots are checked."""
+
+  def __init__(self, entry, people):
+    self.entry = entry
+    self.remaining = len(people)
+    self.kos = []
+    self.notkos = []
+    self.error = []
+    self.lock = threading.Lock()
+
+  def record(self, person, result, exc_info):
+    """Records a pilot's result, returning True once all are in."""
+    with self.lock:
+      if exc_info:
+        self.error.append(person)
+      elif result[0]:
+        self.kos.append((person, result[0], result[1]))
+      else:
+        self.notkos.append((person, result[1]))
+      self.remaining -= 1
+      return self.remaining == 0
+
+  def results(self):
+    return (sorted(self.kos, key=operator.itemgetter(1, 0)),
+            list(self.notkos), list(self.error))
+
+
+class LookupEngine:
+  """Checks log entries on background threads, reporting pilot by pilot.
+
+  submit() queues an entry and returns at once. Worker threads resolve
+  the entry's pilot IDs in one batch, then check each pilot separately,
+  so a KOS pilot is reported as soon as they resolve rather than after
+  the slowest pilot in the entry. Callbacks run on the worker threads:
+
+    on_pilot(entry, person, reason, cid, exc_info) for every pilot, and
+    on_entry(entry, kos, notkos, error) once the entry is finished, with
+        the same lists as KosChecker.koscheck_logentry.
+  """
+
+  def __init__(self, checker, on_pilot, on_entry=None,
+               workers=DEFAULT_WORKERS):
+    self.checker = checker
+    self.on_pilot = on_pilot
+    self.on_entry = on_entry
+    self.queue = Queue.Queue()
+    self.threads = []
+    for _ in range(max(1, workers)):
+      thread = threading.Thread(target=self._work)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, entry):
+    self.queue.put((self._start_entry, (entry,)))
+
+  def pending(self):
+    """Roughly how many jobs are waiting for a worker."""
+    return self.queue.qsize()
+
+  def close(self):
+    for _ in self.threads:
+      self.queue.put(None)
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        return
+      func, args = job
+      try:
+        func(*args)
+      except Exception:
+        # Keep the worker alive for the next entry.
+        traceback.print_exc()
+
+  def _start_entry(self, entry):
+    people = clean_pilots(entry.pilots)
+    progress = _EntryProgress(entry, people)
+    if not people:
+      self._finish(progress)
+      return
+    try:
+      cids = self.checker.character_ids_from_names(people)
+    except Exception:
+      # Each pilot's own check will resolve their ID instead.
+      cids = {}
+    for person in people:
+      self.queue.put((self._check_pilot, (progress, person, cids.get(person))))
+
+  def _check_pilot(self, progress, person, cid):
+    result, exc_info = self.checker._koscheck_captured((person, cid))
+    reason, cid = result if result else (None, cid)
+    self.on_pilot(progress.entry, person, reason, cid, exc_info)
+    if progress.record(person, result, exc_info):
+      self._finish(progress)
+
+  def _finish(self, progress):
+    if self.on_entry:
+      self.on_entry(progress.entry, *progress.results())
+
+
+def _isotime(when):
+  """Formats a time.time() value as UTC ISO 8601, to the millisecond."""
+  stamp = datetime.datetime.utcfromtimestamp(when)
+  return stamp.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (
+      stamp.microsecond // 1000)
+
+
+class JsonStream:
+  """Writes lookup results to out as JSON lines, as soon as they resolve.
+
+  Each pilot gets a line as their check finishes, and each entry another
+  once all its pilots are done:
+
+    {"type": "pilot", "pilot", "kos", "reason", "class", "character_id",
+     "error", ...}
+    {"type": "entry", "kos": [names], "notkos": [names], "error": [names],
+     ...}
+
+  Both also carry the entry's "comment", when it was "seen" and when the
+  line was written ("time", both UTC ISO 8601), and the "latency_ms" in
+  between. Lines are written whole and flushed, from the lookup threads.
+  """
+
+  def __init__(self, checker, out, workers=DEFAULT_WORKERS):
+    self.out = out
+    self.lock = threading.Lock()
+    # id(entry) -> when it was submitted, until it is finished.
+    self.started = {}
+    self.engine = LookupEngine(checker, self._on_pilot, self._on_entry,
+                               workers)
+
+  def submit(self, entry):
+    with self.lock:
+      self.started[id(entry)] = time.time()
+    self.engine.submit(entry)
+
+  def close(self):
+    self.engine.close()
+
+  def _on_pilot(self, entry, person, reason, cid, exc_info):
+    if exc_info:
+      record = {'kos': None, 'reason': None, 'class': None,
+                'error': unicode(exc_info[1]) or exc_info[0].__name__}
+    else:
+      record = {'kos': bool(reason), 'reason': reason,
+                'class': verdict_class(reason), 'error': None}
+    record.update(type='pilot', pilot=person, character_id=cid)
+    self._write(entry, record)
+
+  def _on_entry(self, entry, kos, notkos, error):
+    self._write(entry, {
+        'type': 'entry',
+        'kos': [person for (person, reason, cid) in kos],
+        'notkos': [person for (person, cid) in notkos],
+        'error': list(error),
+    }, finished=True)
+
+  def _write(self, entry, record, finished=False):
+    now = time.time()
+    with self.lock:
+      if finished:
+        started = self.started.pop(id(entry), now)
+      else:
+        started = self.started.get(id(entry), now)
+      record.update(comment=entry.comment, seen=_isotime(started),
+                    time=_isotime(now),
+                    latency_ms=round((now - started) * 1000, 1))
+      self.out.write(json.dumps(record, sort_keys=True) + '\n')
+      self.out.flush()
+
+
+class Prefetcher:
+  """Warms the caches for pilots seen talking, before anyone reports them.
+
+  add() is cheap and never blocks the tailer: names seen recently are
+  ignored, and names arriving while the queue is full are dropped. A
+  single background thread resolves queued names in batches and runs
+  koscheck on each, so it never holds more than one lookup's worth of
+  connections, and once the pilot is reported the verdict is cached.
+  """
+
+  def __init__(self, checker, max_pending=PREFETCH_QUEUE,
+               remember=PREFETCH_REMEMBER):
+    self.checker = checker
+    self.queue = Queue.Queue(max_pending)
+    self.seen = KosCache.RecentSet(remember)
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self._work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def add(self, name):
+    name = name.strip(' .')
+    if not name:
+      return
+    with self.lock:
+      if not self.seen.add(name.lower()):
+        return
+    try:
+      self.queue.put_nowait(name)
+    except Queue.Full:
+      self.checker.stats.increment('prefetch_dropped')
+
+  def close(self):
+    self.queue.put(None)
+
+  def _work(self):
+    with KosHttp.priority(KosHttp.BACKGROUND):
+      self._prefetch()
+
+  def _prefetch(self):
+    while True:
+      names = [self.queue.get()]
+      while names[-1] is not None and len(names) < ID_BATCH_SIZE:
+        try:
+          names.append(self.queue.get_nowait())
+        except Queue.Empty:
+          break
+      done = names[-1] is None
+      names = [name for name in names if name is not None]
+      try:
+        cids = self.checker.character_ids_from_names(names)
+      except Exception:
+        cids = {}
+      for name in names:
+        try:
+          self.checker.koscheck(name, cids.get(name))
+          self.checker.stats.increment('prefetched')
+        except Exception:
+          # It'll be tried again for real if they are ever reported.
+          pass
+      if done:
+        return
+
+
 def stdout_handler(comment, kos, notkos, error):
   fmt = '%s%6s (%3d) %s\033[0m'
   if comment:
@@ -256,10 +1193,10 @@ def stdout_handler(comment, kos, notkos, error):
   if len(error) > 0:
     print fmt % ('\033[33m', 'Error', len(error), len(error) * '*')
   print
-  for (person, reason) in kos:
+  for (person, reason, cid) in kos:
     print u'\033[31m[\u2212] %s\033[0m (%s)' % (person, reason)
   print
-  for person in notkos:
+  for (person, cid) in notkos:
     print '\033[34m[+] %s\033[0m' % person
   print
   for person in error:
@@ -267,10 +1204,46 @@ def stdout_handler(comment, kos, notkos, error):
   print '-----'
 
 
+def stats_handler(stats, handler):
+  """Wraps a loop handler to dump stats to stderr after every entry."""
+  def wrapped(*args):
+    handler(*args)
+    print >>sys.stderr, stats.format()
+  return wrapped
+
+
 if __name__ == '__main__':
-  if len(sys.argv) > 1:
-    KosChecker().loop(sys.argv[1], stdout_handler)
+  args = sys.argv[1:]
+  stats = KosStats.DISABLED
+  handler = stdout_handler
+  prefetch = False
+  server = None
+  as_json = False
+  while args and args[0] in ('--stats', '--prefetch', '--server', '--json'):
+    if args[0] == '--stats':
+      stats = KosStats.Stats()
+      handler = stats_handler(stats, handler)
+    elif args[0] == '--prefetch':
+      prefetch = True
+    elif args[0] == '--json':
+      as_json = True
+    else:
+      server = args[1] if len(args) > 1 else None
+      args = args[1:]
+    args = args[1:]
+  if server:
+    # Ask a shared KosServer instead of the KOS site.
+    import KosServer
+    checker = KosServer.RemoteChecker(server, stats=stats)
+  else:
+    checker = KosChecker(stats=stats)
+  if args and as_json:
+    checker.stream(args[0], prefetch=prefetch)
+  elif args:
+    checker.loop(args[0], handler, prefetch)
   else:
-    print ('Usage: %s ~/EVE/logs/ChatLogs/Fleet_YYYYMMDD_HHMMSS.txt' %
-           sys.argv[0])
+    print ('Usage: %s [--stats] [--prefetch] [--server URL] [--json] '
+           '~/EVE/logs/ChatLogs/Fleet_YYYYMMDD_HHMMSS.txt\n'
+           'With --json, results are written as JSON lines, and the log may '
+           'be a whole directory.' % sys.argv[0])
 
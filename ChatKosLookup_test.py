@@ -1,11 +1,19 @@
+import datetime
+import io
+import json
 import tempfile
+import threading
+import time
 import unittest
 import os
+import shutil
 import sys
 
 sys.path.append('evelink-api')
 
 import ChatKosLookup
+import ChatLogWatcher
+import KosStats
 from ChatKosLookup import Entry
 
 
@@ -62,10 +70,560 @@ class TestFileTailer(unittest.TestCase):
         Entry(('Admiral L Jenkins',), '[00:23:56] Admiral L Jenkins >',
         			(0, 23, 'Admiral L Jenkins', ('Admiral L Jenkins',), None)))
 
+  def test_check_kos_uppercase(self):
+    answer = self.ft.check("[ 2012.07.29 00:23:56 ] Foo Bar > XXX Bad Pilot")
+    self.assertEquals(answer.pilots, ('Bad Pilot',))
+
+  def test_check_xxx_later_in_line(self):
+    line = "[ 2012.07.29 00:23:56 ] Foo Bar > not xxx Bad Pilot"
+    self.assertEquals(self.ft.check(line), None)
+
+  def test_parse_timestamp(self):
+    self.assertEquals(ChatKosLookup.parse_timestamp('2012.07.29', '00:23:56'),
+                      datetime.datetime(2012, 7, 29, 0, 23, 56))
+
+  def append(self, data):
+    with open(self.tmpfile, 'ab') as f:
+      f.write(data)
+
+  def test_poll_partial_line(self):
+    data = u'\ufeff[ 2012.07.29 00:23:56 ] Foo Bar > xxx Bad Pilot\r\n'
+    data = data.encode('utf-16-le')
+    # Split inside a UTF-16 code unit, in the middle of the line.
+    self.append(data[:51])
+    self.assertEquals(self.ft.poll(), None)
+    self.append(data[51:-4])
+    self.assertEquals(self.ft.poll(), None)
+    self.append(data[-4:])
+    self.assertEquals(self.ft.poll(),
+        Entry(('Bad Pilot',), '[00:23:56] Foo Bar >',
+              (0, 23, 'Foo Bar', ('Bad Pilot',), None)))
+    self.assertEquals(self.ft.poll(), None)
+
+  def test_poll_many_lines(self):
+    line = u'[ 2012.07.29 00:23:56 ] Foo Bar > nothing much\r\n'
+    report = u'[ 2012.07.29 00:24:56 ] Foo Bar > xxx Pilot %d\r\n'
+    lines = [line] * 5000 + [report % i for i in range(3)]
+    self.append((u'\ufeff' + u''.join(lines)).encode('utf-16-le'))
+    answers = list(iter(self.ft.poll, None))
+    self.assertEquals([a.pilots for a in answers],
+                      [('Pilot 0',), ('Pilot 1',), ('Pilot 2',)])
+
+  def test_poll_existing_log(self):
+    self.append(u'\ufeff[ 2012.07.29 00:23:56 ] Foo Bar > hi\r\n'.encode('utf-16-le'))
+    ft = ChatKosLookup.FileTailer(self.tmpfile)
+    self.append(u'[ 2012.07.29 00:23:57 ] Foo Bar > xxx Bad Pilot\r\n'.encode('utf-16-le'))
+    self.assertEquals(ft.poll().pilots, ('Bad Pilot',))
+    ft.close()
+
+  def test_from_start(self):
+    line = u'\ufeff[ 2012.07.29 00:23:56 ] Foo Bar > xxx Bad Pilot\r\n'
+    self.append(line.encode('utf-16-le'))
+    ft = ChatKosLookup.FileTailer(self.tmpfile)
+    self.assertEquals(ft.poll(), None)
+    ft.close()
+    ft = ChatKosLookup.FileTailer(self.tmpfile, from_start=True)
+    self.assertEquals(ft.poll().pilots, ('Bad Pilot',))
+    ft.close()
+
+  def test_speakers(self):
+    speakers = []
+    ft = ChatKosLookup.FileTailer(self.tmpfile, on_speaker=speakers.append)
+    ft.check(u'[ 2012.07.29 00:23:56 ] Foo Bar > o7')
+    ft.check(u'[ 2012.07.29 00:23:57 ] EVE System > Channel changed')
+    ft.check(u'[ 2012.07.29 00:23:58 ] Baz > xxx Bad Pilot')
+    ft.check(u'not a chat line')
+    self.assertEquals(speakers, [u'Foo Bar', u'Baz'])
+    ft.close()
+
   def tearDown(self):
     self.ft.close()
     os.unlink(self.tmpfile)
 
 
+class TestDirectoryTailer(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.stats = KosStats.Stats()
+    for i in range(5):
+      self.append(i, u'\ufeff[ 2012.07.29 00:23:56 ] Foo Bar > hi\r\n')
+
+  def log(self, i):
+    return os.path.join(self.tmpdir, 'Fleet_%d.txt' % i)
+
+  def append(self, i, line):
+    with open(self.log(i), 'ab') as f:
+      f.write(line.encode('utf-16-le'))
+
+  def tailer(self, **kwargs):
+    return ChatKosLookup.DirectoryTailer(
+        self.tmpdir, notifier=ChatLogWatcher.PollingWatcher(self.tmpdir),
+        stats=self.stats, **kwargs)
+
+  def report(self, i):
+    self.append(i, u'[ 2012.07.29 00:24:00 ] Foo Bar > xxx Pilot %d\r\n' % i)
+
+  def test_open_limit(self):
+    tailer = self.tailer(max_open=1)
+    # Nothing is opened until it's written to.
+    self.assertEquals(tailer.counts(), {'watched': 5, 'open': 0})
+    for i in (0, 3):
+      self.report(i)
+    tailer.wait(0)
+    self.assertEquals(sorted(tailer.poll().pilots + tailer.poll().pilots),
+                      ['Pilot 0', 'Pilot 3'])
+    self.assertEquals(tailer.poll(), None)
+    self.assertEquals(tailer.counts(), {'watched': 5, 'open': 1})
+    # The log closed to make room picks up where it left off.
+    self.report(0)
+    self.report(3)
+    tailer.wait(0)
+    self.assertEquals(sorted(tailer.poll().pilots + tailer.poll().pilots),
+                      ['Pilot 0', 'Pilot 3'])
+    self.assertEquals(tailer.counts(), {'watched': 5, 'open': 1})
+    counters = self.stats.snapshot()['counters']
+    self.assertEquals(counters['tail_opened'], 2)
+    self.assertEquals(counters['tail_reopened'], counters['tail_closed'] - 1)
+    tailer.close()
+
+  def test_closed_logs_checked_on_wakeup(self):
+    tailer = self.tailer()
+    checks = []
+    for watcher in tailer.watchers.itervalues():
+      watcher.changed = lambda: checks.append(1)
+    for _ in range(10):
+      self.assertEquals(tailer.poll(), None)
+    self.assertEquals(checks, [])
+    tailer.wait(0)
+    self.assertEquals(tailer.poll(), None)
+    self.assertEquals(len(checks), 5)
+    tailer.close()
+
+  def test_skips_old_log_names(self):
+    for name in ('Local_20000101_000000.txt', 'Local_20000101_000000_1.txt',
+                 time.strftime('Local_%Y%m%d_%H%M%S.txt', time.gmtime()),
+                 'notes.txt'):
+      open(os.path.join(self.tmpdir, name), 'wb').close()
+    tailer = self.tailer()
+    names = set(os.path.basename(f) for f in tailer.watchers)
+    self.assertFalse('Local_20000101_000000.txt' in names)
+    self.assertFalse('Local_20000101_000000_1.txt' in names)
+    self.assertEquals(len(names), 7)
+    tailer.close()
+
+  def test_evicts_rotated_logs(self):
+    old = time.time() - 2 * ChatKosLookup.LOG_WINDOW
+    os.utime(self.log(4), (old, old))
+    tailer = self.tailer()
+    self.assertEquals(tailer.counts(), {'watched': 4, 'open': 0})
+    os.utime(self.log(3), (old, old))
+    tailer.wait(0)
+    self.assertEquals(tailer.poll(), None)
+    os.unlink(self.log(2))
+    self.append(5, u'\ufeff')
+    tailer.wait(0)
+    self.assertEquals(tailer.poll(), None)
+    self.assertEquals(sorted(tailer.watchers),
+                      [self.log(i) for i in (0, 1, 5)])
+    self.assertEquals(self.stats.snapshot()['counters']['tail_evicted'], 2)
+    tailer.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+
+class SlowChecker(ChatKosLookup.KosChecker):
+  """Answers from a fixed table, taking longer for earlier pilots."""
+
+  VERDICTS = {
+      'Bad Pilot': 'pilot: Bad Pilot',
+      'Worse Pilot': 'corp: Evil Corp',
+  }
+
+  batches = 0
+
+  def character_ids_from_names(self, names):
+    self.batches += 1
+    return dict((name, len(name)) for name in names)
+
+  def koscheck(self, player, cid=None):
+    time.sleep(0.01 * (5 - len(player) % 5))
+    if player == 'Broken Pilot':
+      raise ValueError(player)
+    return self.VERDICTS.get(player), cid
+
+
+class CheckerTestCase(unittest.TestCase):
+  """Gives each test its own checker cache, rather than the GUI's."""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cache_file = os.path.join(self.tmpdir, 'koscheck')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+
+class TestKosChecker(CheckerTestCase):
+  def test_logentry_order(self):
+    checker = SlowChecker(max_workers=4, cache_file=self.cache_file)
+    names = ('Good Pilot', 'Worse Pilot', 'Bad Pilot', 'Nice Pilot', ' ')
+    self.assertEquals(checker.koscheck_logentry(names),
+        ([('Worse Pilot', 'corp: Evil Corp', 11),
+          ('Bad Pilot', 'pilot: Bad Pilot', 9)],
+         [('Good Pilot', 10), ('Nice Pilot', 10)],
+         []))
+    self.assertEquals(checker.batches, 1)
+
+  def test_logentry_serial(self):
+    checker = SlowChecker(max_workers=1, cache_file=self.cache_file)
+    kos, notkos, error = checker.koscheck_logentry(('Bad Pilot.',))
+    self.assertEquals(kos, [('Bad Pilot', 'pilot: Bad Pilot', 9)])
+
+  def test_character_ids_batched(self):
+    checker = ChatKosLookup.KosChecker(cache_file=self.cache_file)
+    requests = []
+    class FakeEve:
+      def character_ids_from_names(self, names):
+        requests.append(list(names))
+        return dict((name.upper(), len(name)) for name in names)
+    checker.eve = FakeEve()
+    names = ['Pilot %d' % i for i in range(ChatKosLookup.ID_BATCH_SIZE + 1)]
+    ids = checker.character_ids_from_names(names)
+    self.assertEquals(ids['Pilot 1'], 7)
+    self.assertEquals([len(r) for r in requests],
+                      [ChatKosLookup.ID_BATCH_SIZE, 1])
+    checker.character_ids_from_names(['pilot 1', 'Pilot 2'])
+    self.assertEquals(len(requests), 2)
+
+  def test_logentry_error(self):
+    checker = SlowChecker(max_workers=4, cache_file=self.cache_file)
+    self.assertRaises(ValueError, checker.koscheck_logentry,
+        ('Good Pilot', 'Broken Pilot'))
+
+  def test_one_pool_started(self):
+    checker = SlowChecker(max_workers=2, cache_file=self.cache_file)
+    started = []
+    pool_class = ChatKosLookup.ThreadPool
+    def slow_start_pool(processes):
+      started.append(processes)
+      time.sleep(0.05)
+      return pool_class(processes)
+    ChatKosLookup.ThreadPool = slow_start_pool
+    try:
+      threads = [threading.Thread(target=checker.map, args=(len, ['a', 'b']))
+                 for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join(5)
+    finally:
+      ChatKosLookup.ThreadPool = pool_class
+    self.assertEquals(started, [2])
+
+
+class TestLookupEngine(CheckerTestCase):
+  def test_progressive_results(self):
+    checker = SlowChecker(cache_file=self.cache_file)
+    pilots = []
+    entries = []
+    done = threading.Event()
+    def on_entry(*args):
+      entries.append(args)
+      done.set()
+    engine = ChatKosLookup.LookupEngine(
+        checker, lambda *args: pilots.append(args[1:4]), on_entry, workers=4)
+    entry = Entry(('Good Pilot', 'Worse Pilot', 'Bad Pilot', ' '), 'comment',
+                  None)
+    engine.submit(entry)
+    self.assertTrue(done.wait(5))
+    engine.close()
+    self.assertEquals(sorted(pilots), [
+        ('Bad Pilot', 'pilot: Bad Pilot', 9),
+        ('Good Pilot', None, 10),
+        ('Worse Pilot', 'corp: Evil Corp', 11)])
+    # The KOS pilot answers fastest, so is reported before the others.
+    self.assertEquals(pilots[0][0], 'Bad Pilot')
+    self.assertEquals(entries, [(entry,) + checker.koscheck_logentry(
+        entry.pilots)])
+    self.assertEquals(checker.batches, 2)
+
+  def test_errors_reported(self):
+    done = threading.Event()
+    errors = []
+    engine = ChatKosLookup.LookupEngine(
+        SlowChecker(cache_file=self.cache_file),
+        lambda *args: errors.append(args[4]), lambda *args: done.set())
+    engine.submit(Entry(('Broken Pilot',), None, None))
+    self.assertTrue(done.wait(5))
+    engine.close()
+    self.assertEquals(errors[0][0], ValueError)
+
+
+class TestPrefetcher(CheckerTestCase):
+  def test_prefetch(self):
+    checker = SlowChecker(cache_file=self.cache_file)
+    checked = []
+    checker.koscheck = lambda name, cid: checked.append((name, cid))
+    prefetcher = ChatKosLookup.Prefetcher(checker)
+    for name in ('Bad Pilot', 'bad pilot', 'Good Pilot.', ' '):
+      prefetcher.add(name)
+    prefetcher.close()
+    prefetcher.thread.join(5)
+    self.assertEquals(sorted(checked), [('Bad Pilot', 9), ('Good Pilot', 10)])
+
+  def test_full_queue_drops(self):
+    checker = SlowChecker(cache_file=self.cache_file)
+    release = threading.Event()
+    checker.character_ids_from_names = lambda names: release.wait() or {}
+    checker.koscheck = lambda name, cid: None
+    prefetcher = ChatKosLookup.Prefetcher(checker, max_pending=1)
+    prefetcher.add('Pilot 1')
+    time.sleep(0.05)
+    prefetcher.add('Pilot 2')
+    # Doesn't block, however far behind the prefetcher is.
+    prefetcher.add('Pilot 3')
+    self.assertEquals(prefetcher.queue.qsize(), 1)
+    release.set()
+    prefetcher.close()
+    prefetcher.thread.join(5)
+
+
+class TestJsonStream(CheckerTestCase):
+  def test_lines(self):
+    out = io.BytesIO()
+    finished = threading.Event()
+    stream = ChatKosLookup.JsonStream(
+        SlowChecker(cache_file=self.cache_file), out)
+    on_entry = stream.engine.on_entry
+    stream.engine.on_entry = lambda *args: (on_entry(*args), finished.set())
+    stream.submit(Entry(('Good Pilot', 'Bad Pilot', 'Broken Pilot'),
+                        '[00:23:56] Foo Bar >', None))
+    self.assertTrue(finished.wait(5))
+    stream.close()
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    self.assertEquals([line['type'] for line in lines],
+                      ['pilot', 'pilot', 'pilot', 'entry'])
+    pilots = dict((line['pilot'], line) for line in lines[:3])
+    self.assertEquals(pilots['Bad Pilot']['class'], ChatKosLookup.KOS)
+    self.assertEquals(pilots['Bad Pilot']['character_id'], 9)
+    self.assertEquals(pilots['Good Pilot']['kos'], False)
+    self.assertEquals(pilots['Broken Pilot']['error'], 'Broken Pilot')
+    entry = lines[-1]
+    self.assertEquals((entry['kos'], entry['notkos'], entry['error']),
+                      (['Bad Pilot'], ['Good Pilot'], ['Broken Pilot']))
+    self.assertEquals(entry['comment'], '[00:23:56] Foo Bar >')
+    self.assertTrue(entry['latency_ms'] >= pilots['Good Pilot']['latency_ms'])
+    self.assertTrue(entry['time'].endswith('Z'))
+    self.assertEquals(stream.started, {})
+
+  def test_unicode_error(self):
+    out = io.BytesIO()
+    finished = threading.Event()
+    checker = SlowChecker(cache_file=self.cache_file)
+    def fail(player, cid=None):
+      raise ValueError(u'no such pilot: J\xf6rg')
+    checker.koscheck = fail
+    stream = ChatKosLookup.JsonStream(checker, out)
+    on_entry = stream.engine.on_entry
+    stream.engine.on_entry = lambda *args: (on_entry(*args), finished.set())
+    stream.submit(Entry(('Bad Pilot',), '[00:23:56] Foo Bar >', None))
+    self.assertTrue(finished.wait(5))
+    stream.close()
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    self.assertEquals(lines[0]['error'], u'no such pilot: J\xf6rg')
+    self.assertEquals(lines[1]['error'], ['Bad Pilot'])
+
+
+class HistoryChecker(ChatKosLookup.KosChecker):
+  """A pilot in an NPC corp whose last player corp is KOS."""
+
+  def __init__(self, cache_file):
+    ChatKosLookup.KosChecker.__init__(self, cache_file=cache_file)
+    self.cache = ChatKosLookup.KosCache.MemoryCache()
+    self.lookups = []
+
+  def character_id(self, player):
+    return 42
+
+  def corp_history(self, cid):
+    return [(1, 'NPC Corp'), (2, 'Evil Corp')]
+
+  def koscheck_internal_stamped(self, entity, fresh=False):
+    self.lookups.append(entity)
+    return {'Evil Corp': 'corp: Evil Corp',
+            'NPC Corp': ChatKosLookup.NPC,
+            'Nice Corp': None}.get(entity, ChatKosLookup.NPC), False
+
+
+class FakeKosHttp:
+  """Answers every KOS site query with the same units."""
+
+  def __init__(self, units):
+    self.units = units
+    self.requests = 0
+
+  def request(self, url, data=None):
+    self.requests += 1
+    return json.dumps({'results': self.units})
+
+
+class TestVerdictCache(CheckerTestCase):
+  def test_lastcorp_cached(self):
+    checker = HistoryChecker(self.cache_file)
+    self.assertEquals(checker.koscheck('Some Pilot'),
+                      ('lastcorp: corp: Evil Corp', 42))
+    self.assertEquals(len(checker.lookups), 3)
+    self.assertEquals(checker.koscheck('some pilot'),
+                      ('lastcorp: corp: Evil Corp', 42))
+    self.assertEquals(len(checker.lookups), 3)
+
+  def test_notkos_cached(self):
+    checker = HistoryChecker(self.cache_file)
+    checker.corp_history = lambda cid: [(3, 'Nice Corp')]
+    self.assertEquals(checker.koscheck('Some Pilot'), (None, 42))
+    self.assertEquals(checker.koscheck('Some Pilot'), (None, 42))
+    self.assertEquals(checker.lookups, ['Some Pilot', 'Nice Corp'])
+
+  def test_ttl_zero_disables(self):
+    checker = HistoryChecker(self.cache_file)
+    checker.verdict_ttls[ChatKosLookup.LASTCORP] = 0
+    checker.koscheck('Some Pilot')
+    checker.koscheck('Some Pilot')
+    # The pilot is looked up again, but their corps' verdicts are cached.
+    self.assertEquals(checker.lookups,
+                      ['Some Pilot', 'NPC Corp', 'Evil Corp', 'Some Pilot'])
+
+  def test_corp_verdicts_shared(self):
+    checker = HistoryChecker(self.cache_file)
+    checker.koscheck('Some Pilot')
+    checker.koscheck('Other Pilot')
+    self.assertEquals(checker.lookups,
+                      ['Some Pilot', 'NPC Corp', 'Evil Corp', 'Other Pilot'])
+
+  def test_history_order(self):
+    checker = HistoryChecker(self.cache_file)
+    history = [(i, 'NPC Corp') for i in range(10)] + [
+        (10, 'Evil Corp'), (11, 'Nice Corp'), (12, 'Evil Corp')]
+    self.assertEquals(checker.first_player_corp(history),
+                      (True, 'corp: Evil Corp'))
+    # Lookups stop within a window of the answer.
+    self.assertTrue(len(checker.lookups) <= 11 + ChatKosLookup.HISTORY_WINDOW)
+
+  def test_history_serial(self):
+    checker = HistoryChecker(self.cache_file)
+    checker.max_workers = 1
+    history = [(1, 'NPC Corp'), (3, 'Nice Corp'), (2, 'Evil Corp')]
+    self.assertEquals(checker.first_player_corp(history), (True, None))
+    self.assertEquals(checker.lookups, ['NPC Corp', 'Nice Corp'])
+
+  def test_one_history_pool_started(self):
+    checker = HistoryChecker(self.cache_file)
+    started = []
+    pool_class = ChatKosLookup.ThreadPool
+    def slow_start_pool(processes):
+      started.append(processes)
+      time.sleep(0.05)
+      return pool_class(processes)
+    ChatKosLookup.ThreadPool = slow_start_pool
+    try:
+      threads = [threading.Thread(target=checker.first_player_corp,
+                                  args=([(1, 'Evil Corp')],))
+                 for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join(5)
+    finally:
+      ChatKosLookup.ThreadPool = pool_class
+    self.assertEquals(len(started), 1)
+
+  def test_history_all_npc(self):
+    checker = HistoryChecker(self.cache_file)
+    self.assertEquals(checker.first_player_corp([(1, 'NPC Corp')]),
+                      (True, ChatKosLookup.NPC))
+
+  def test_stale_verdict_served(self):
+    checker = HistoryChecker(self.cache_file)
+    key = checker.api._cache_key(ChatKosLookup.VERDICT_KEY,
+                                 {'pilot': 'some pilot'})
+    checker.cache.put_stamped(key, ('old: reason', 42), -1, 60)
+    self.assertEquals(checker.koscheck('Some Pilot'), ('old: reason', 42))
+    checker.refresh_pool.close()
+    checker.refresh_pool.join()
+    self.assertEquals(checker.cache.get_stamped(key),
+                      (('lastcorp: corp: Evil Corp', 42), False))
+
+  def test_stale_kos_result_served(self):
+    checker = ChatKosLookup.KosChecker(cache_file=self.cache_file)
+    checker.cache = ChatKosLookup.KosCache.MemoryCache()
+    fetched = []
+    def fetch(cache_key, entity):
+      fetched.append(entity)
+      checker.cache.put_stamped(cache_key, {'results': []}, 60)
+    checker._fetch_kos = fetch
+    key = checker.api._cache_key(checker.kos_url, {'entity': 'Bad Pilot'})
+    checker.cache.put_stamped(key, {'results': [
+        {'label': 'Bad Pilot', 'type': 'pilot', 'kos': True}]}, -1, 60)
+    self.assertEquals(checker.koscheck_internal('Bad Pilot'),
+                      'pilot: Bad Pilot')
+    checker.refresh_pool.close()
+    checker.refresh_pool.join()
+    self.assertEquals(fetched, ['Bad Pilot'])
+    self.assertEquals(checker.koscheck_internal('Bad Pilot'), None)
+
+  def test_stale_verdict_refetched(self):
+    checker = ChatKosLookup.KosChecker(cache_file=self.cache_file,
+                                       stats=KosStats.Stats())
+    checker.cache = ChatKosLookup.KosCache.MemoryCache()
+    checker.http = FakeKosHttp([
+        {'label': 'Bad Pilot', 'type': 'pilot', 'kos': True}])
+    verdict_key = checker.api._cache_key(ChatKosLookup.VERDICT_KEY,
+                                         {'pilot': 'bad pilot'})
+    kos_key = checker.api._cache_key(checker.kos_url, {'entity': 'Bad Pilot'})
+    # Both the verdict and the site answer it came from are stale.
+    checker.cache.put_stamped(verdict_key, (None, 42), -1, 60)
+    checker.cache.put_stamped(kos_key, {'results': []}, -1, 60)
+    self.assertEquals(checker.koscheck('Bad Pilot', 42), (None, 42))
+    checker.refresh_pool.close()
+    checker.refresh_pool.join()
+    self.assertEquals(checker.cache.get_stamped(verdict_key),
+                      (('pilot: Bad Pilot', 42), False))
+    self.assertEquals(checker.http.requests, 1)
+
+  def test_verdict_from_stale_answer_not_cached(self):
+    checker = ChatKosLookup.KosChecker(cache_file=self.cache_file)
+    checker.cache = ChatKosLookup.KosCache.MemoryCache()
+    checker.http = FakeKosHttp([
+        {'label': 'Bad Pilot', 'type': 'pilot', 'kos': True}])
+    checker.corp_history = lambda cid: []
+    kos_key = checker.api._cache_key(checker.kos_url, {'entity': 'Bad Pilot'})
+    checker.cache.put_stamped(kos_key, {'results': []}, -1, 60)
+    self.assertEquals(checker.koscheck('Bad Pilot', 42), (None, 42))
+    checker.refresh_pool.close()
+    checker.refresh_pool.join()
+    # The refreshed answer is used at the next sighting.
+    self.assertEquals(checker.koscheck('Bad Pilot', 42),
+                      ('pilot: Bad Pilot', 42))
+    self.assertEquals(checker.http.requests, 1)
+
+  def test_failed_revalidation_counted(self):
+    checker = HistoryChecker(self.cache_file)
+    checker.stats = KosStats.Stats()
+    def fail(*args):
+      raise IOError('down')
+    checker._revalidate('key', fail)
+    checker.refresh_pool.close()
+    checker.refresh_pool.join()
+    self.assertEquals(
+        checker.stats.snapshot()['counters']['revalidate_failed'], 1)
+
+  def test_verdict_class(self):
+    self.assertEquals(ChatKosLookup.verdict_class(None), ChatKosLookup.NOTKOS)
+    self.assertEquals(ChatKosLookup.verdict_class('CCP'), ChatKosLookup.KOS)
+    self.assertEquals(ChatKosLookup.verdict_class('lastcorp: corp: X'),
+                      ChatKosLookup.LASTCORP)
+
+
 if __name__ == '__main__':
   unittest.main()
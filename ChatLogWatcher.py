@@ -0,0 +1,104 @@
+"""Waits for something to be written to a chat log directory.
+
+On Linux this uses inotify, so waiting costs nothing while the logs are
+quiet and wakes up as soon as a line lands. Elsewhere it falls back to
+sleeping for a fixed interval and letting the caller poll.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import sys
+import time
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+POLL_INTERVAL = 1.0
+
+
+class PollingWatcher:
+  """Fallback watcher: waking up every interval is all it can do."""
+
+  event_driven = False
+
+  def __init__(self, path, interval=POLL_INTERVAL):
+    self.path = path
+    self.interval = interval
+
+  def wait(self, timeout=None):
+    """Sleeps for up to an interval, then reports that something may be new."""
+    if timeout is None:
+      timeout = self.interval
+    time.sleep(min(timeout, self.interval))
+    return True
+
+  def close(self):
+    pass
+
+
+class InotifyWatcher:
+  """Watches a directory for files being created or written to."""
+
+  event_driven = True
+
+  def __init__(self, path):
+    if not sys.platform.startswith('linux'):
+      raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    self.path = path
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+    if isinstance(path, unicode):
+      path = path.encode(sys.getfilesystemencoding())
+    if libc.inotify_add_watch(self.fd, path, mask) < 0:
+      err = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(err, 'inotify_add_watch failed', path)
+
+  def wait(self, timeout=None):
+    """Blocks until the directory changes or timeout seconds pass.
+
+    @returns: True if something changed.
+    """
+    try:
+      readable, _, _ = select.select([self.fd], [], [], timeout)
+    except (select.error, ValueError):
+      if self.fd < 0:
+        # Closed by another thread while we were waiting.
+        return False
+      raise
+    if not readable:
+      return False
+    # The events themselves don't matter, only that there were some.
+    try:
+      while os.read(self.fd, 65536):
+        pass
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+    return True
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+
+def create_watcher(path):
+  """Returns the best watcher available for path on this platform."""
+  try:
+    return InotifyWatcher(path)
+  except (OSError, AttributeError):
+    return PollingWatcher(path)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import ChatLogWatcher
+
+
+class TestWatchers(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def test_create_watcher(self):
+    watcher = ChatLogWatcher.create_watcher(self.tmpdir)
+    self.assertEquals(watcher.event_driven,
+                      sys.platform.startswith('linux'))
+    watcher.close()
+
+  def test_polling_watcher(self):
+    watcher = ChatLogWatcher.PollingWatcher(self.tmpdir, interval=0.01)
+    self.assertTrue(watcher.wait())
+
+  @unittest.skipUnless(sys.platform.startswith('linux'), 'needs inotify')
+  def test_inotify_watcher(self):
+    watcher = ChatLogWatcher.InotifyWatcher(self.tmpdir)
+    self.assertFalse(watcher.wait(0.01))
+    with open(os.path.join(self.tmpdir, 'Fleet.txt'), 'wb') as f:
+      f.write('x')
+    self.assertTrue(watcher.wait(1.0))
+    self.assertFalse(watcher.wait(0.01))
+    watcher.close()
+    self.assertFalse(watcher.wait(0.01))
+
+  @unittest.skipUnless(sys.platform.startswith('linux'), 'needs inotify')
+  def test_inotify_unicode_path(self):
+    path = os.path.join(unicode(self.tmpdir), u'Chatlogs \xe4')
+    try:
+      os.mkdir(path)
+    except UnicodeError:
+      self.skipTest('file system encoding has no \xe4')
+    watcher = ChatLogWatcher.InotifyWatcher(path)
+    with open(os.path.join(path, u'Fleet.txt'), 'wb') as f:
+      f.write('x')
+    self.assertTrue(watcher.wait(1.0))
+    watcher.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
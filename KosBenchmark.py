@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the chat log parser and the KOS lookup path.
+
+Usage: KosBenchmark.py parser [--lines N] [--report-every N]
+       KosBenchmark.py latency [--latency SECONDS] [--rate N] [--pilots N]
+       KosBenchmark.py http [--latency SECONDS] [--handshake SECONDS]
+       KosBenchmark.py standin [--latency SECONDS] [--port N]
+       KosBenchmark.py scan [--logs N] [--recent N] [--repeat N]
+
+'latency' writes xxx reports into a chat log and measures how long each
+takes to be tailed and checked against a local stand-in for the KOS site
+and EVE API, first with an empty cache and then with a warm one.
+'http' compares uncached lookups over fresh and kept-alive connections.
+'standin' just runs that stand-in server.
+'scan' times DirectoryTailer's startup on a big directory of old logs.
+"""
+
+import argparse
+import BaseHTTPServer
+import cgi
+import codecs
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urlparse
+
+import ChatKosLookup
+import ChatLogWatcher
+import KosHttp
+import KosStats
+
+WORDS = ('o7', 'gf', 'lol', 'local', 'spike', 'in', 'gate', 'neut', 'red',
+         'warp', 'to', 'me', 'fleet', 'dock', 'up', 'clear', 'jita', 'bs')
+
+
+def pilot_name(i):
+  return 'Pilot %05d' % i
+
+
+def chat_line(when, speaker, message):
+  return u'[ %s ] %s > %s\r\n' % (
+      when.strftime('%Y.%m.%d %H:%M:%S'), speaker, message)
+
+
+def synthetic_lines(count, report_every=100, pilots=5, seed=0):
+  """Generates count chat lines, one in report_every being an xxx report."""
+  rand = random.Random(seed)
+  when = datetime.datetime(2013, 5, 1, 18, 0, 0)
+  for i in xrange(count):
+    when += datetime.timedelta(seconds=rand.randint(0, 3))
+    speaker = pilot_name(rand.randint(0, 500))
+    if report_every and i % report_every == 0:
+      names = '  '.join(pilot_name(rand.randint(0, 5000))
+                        for _ in range(pilots))
+      message = 'xxx %s' % names
+    else:
+      message = ' '.join(rand.choice(WORDS)
+                         for _ in range(rand.randint(1, 12)))
+    yield chat_line(when, speaker, message)
+
+
+def legacy_check(line):
+  """FileTailer.check as it was before the prefilter: regex + strptime."""
+  m = ChatKosLookup.FileTailer.MATCH.match(line)
+  if not m:
+    return None
+  timestamp = datetime.datetime.strptime(
+      '{} {}'.format(m.group('date'), m.group('time')),
+      '%Y.%m.%d %H:%M:%S')
+  names = m.group('names').replace('  ', '\n')
+  return timestamp, tuple(n.strip() for n in names.splitlines())
+
+
+def time_lines(func, lines):
+  """Returns (lines per second, matches) for func applied to each line."""
+  start = time.time()
+  matches = 0
+  for line in lines:
+    if func(line):
+      matches += 1
+  elapsed = time.time() - start
+  return len(lines) / max(elapsed, 1e-9), matches
+
+
+def bench_parser(args):
+  lines = list(synthetic_lines(args.lines, args.report_every))
+  handle, filename = tempfile.mkstemp(suffix='.txt')
+  os.close(handle)
+  try:
+    tailer = ChatKosLookup.FileTailer(filename)
+    before, before_matches = time_lines(legacy_check, lines)
+    after, after_matches = time_lines(tailer.check, lines)
+    tailer.close()
+
+    # The whole tailing path: decode a big burst of UTF-16 and parse it.
+    tailer = ChatKosLookup.FileTailer(filename)
+    with open(filename, 'ab') as f:
+      f.write((u'\ufeff' + u''.join(lines)).encode('utf-16-le'))
+    start = time.time()
+    polled = len(list(iter(tailer.poll, None)))
+    tail_rate = len(lines) / max(time.time() - start, 1e-9)
+    tailer.close()
+  finally:
+    os.unlink(filename)
+
+  print '%d lines, %d reports' % (len(lines), after_matches)
+  print '%-28s %12.0f lines/s' % ('regex + strptime (before)', before)
+  print '%-28s %12.0f lines/s  (%.1fx)' % (
+      'prefilter + check (after)', after, after / before)
+  print '%-28s %12.0f lines/s' % ('FileTailer.poll end to end', tail_rate)
+  assert before_matches == after_matches == polled
+
+
+# A stand-in for the CVA KOS site and the parts of the EVE API we use.
+#
+# Pilots are called 'Pilot NNNNN' and have character ID PILOT_BASE + N.
+# Every fifth pilot is KOS themselves; every fifth pilot after that sits
+# in an NPC corp, so their employment history is walked; everyone else
+# is not KOS but still gets their history checked, as with the real site.
+PILOT_BASE = 90000000
+CORP_BASE = 98000000
+NPC_CORP_BASE = 1000000
+PLAYER_CORPS = 50
+NPC_CORPS = 7
+
+EVE_XML = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2013-05-01 18:00:00</currentTime>
+  <result>
+%s
+  </result>
+  <cachedUntil>2013-05-01 19:00:00</cachedUntil>
+</eveapi>"""
+
+EVE_ERROR_XML = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2013-05-01 18:00:00</currentTime>
+  <error code="105">Invalid characterID.</error>
+  <cachedUntil>2013-05-01 19:00:00</cachedUntil>
+</eveapi>"""
+
+
+def entity_id(name):
+  """Returns the stand-in ID for a pilot or corp name, or 0 if unknown."""
+  for prefix, base in (('Pilot ', PILOT_BASE), ('NPC Corp ', NPC_CORP_BASE),
+                       ('Corp ', CORP_BASE)):
+    if name.startswith(prefix) and name[len(prefix):].isdigit():
+      return base + int(name[len(prefix):])
+  return 0
+
+
+def entity_name(eid):
+  if eid >= CORP_BASE:
+    return 'Corp %d' % (eid - CORP_BASE)
+  if eid >= PILOT_BASE:
+    return pilot_name(eid - PILOT_BASE)
+  return 'NPC Corp %d' % (eid - NPC_CORP_BASE)
+
+
+def kos_unit(name):
+  """The KOS site's record for name, or None if it has none."""
+  eid = entity_id(name)
+  if not eid:
+    return None
+  if eid >= CORP_BASE:
+    return {'label': name, 'type': 'corp', 'npc': False,
+            'kos': (eid - CORP_BASE) % 3 == 0}
+  if eid >= PILOT_BASE:
+    n = eid - PILOT_BASE
+    if n % 5 == 1:
+      corp = kos_unit('NPC Corp %d' % (n % NPC_CORPS))
+    else:
+      corp = kos_unit('Corp %d' % (n % PLAYER_CORPS))
+    return {'label': name, 'type': 'pilot', 'kos': n % 5 == 0, 'npc': False,
+            'corp': corp}
+  return {'label': name, 'type': 'corp', 'kos': False, 'npc': True}
+
+
+def character_info(cid):
+  n = cid - PILOT_BASE
+  corps = [NPC_CORP_BASE + n % NPC_CORPS, CORP_BASE + n % PLAYER_CORPS,
+           CORP_BASE + (n + 1) % PLAYER_CORPS]
+  rows = '\n'.join(
+      '<row corporationID="%d" startDate="2013-0%d-01 00:00:00" />' % (c, 4 - i)
+      for i, c in enumerate(corps))
+  return ('<characterID>%d</characterID>\n<characterName>%s</characterName>\n'
+          '<rowset name="employmentHistory">\n%s\n</rowset>' % (
+              cid, entity_name(cid), rows))
+
+
+def name_rows(pairs):
+  return '<rowset name="characters">\n%s\n</rowset>' % '\n'.join(
+      '<row name="%s" characterID="%d" />' % (cgi.escape(name, True), eid)
+      for name, eid in pairs)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one go; written line by line, kept-alive
+  # connections would stall on delayed ACKs.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    # Called once per connection, so this stands in for TCP/TLS setup.
+    self.server.count_connection()
+    if self.server.handshake:
+      time.sleep(self.server.handshake)
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+  def do_GET(self):
+    self.respond(urlparse.urlparse(self.path), {})
+
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length') or 0)
+    self.respond(urlparse.urlparse(self.path),
+                 urlparse.parse_qs(self.rfile.read(length)))
+
+  def respond(self, url, form):
+    self.server.count_request()
+    if self.server.latency:
+      time.sleep(self.server.latency)
+    params = urlparse.parse_qs(url.query)
+    params.update(form)
+    if url.path == '/api/':
+      unit = kos_unit(params['q'][0])
+      body = json.dumps({'results': [unit] if unit else []})
+      content_type = 'application/json'
+    else:
+      result = self.eve_result(url.path, params)
+      body = EVE_ERROR_XML if result is None else EVE_XML % result
+      content_type = 'text/xml'
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    if 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+      compressed = io.BytesIO()
+      with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+        f.write(body)
+      body = compressed.getvalue()
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def eve_result(self, path, params):
+    if path == '/eve/CharacterID.xml.aspx':
+      names = params['names'][0].split(',')
+      return name_rows((name, entity_id(name)) for name in names)
+    if path == '/eve/CharacterName.xml.aspx':
+      ids = [int(i) for i in params['IDs'][0].split(',')]
+      return name_rows((entity_name(i), i) for i in ids)
+    if path == '/eve/CharacterInfo.xml.aspx':
+      cid = params['characterID'][0]
+      if not cid.isdigit() or not PILOT_BASE <= int(cid) < CORP_BASE:
+        return None
+      return character_info(int(cid))
+    return ''
+
+  def log_message(self, format, *args):
+    pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Serves the stand-in APIs from a background thread.
+
+  Every response is delayed by latency seconds to mimic the real sites,
+  and every new connection by handshake seconds.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, latency=0.0, port=0, handshake=0.0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                       StandInHandler)
+    self.latency = latency
+    self.handshake = handshake
+    self.requests = 0
+    self.connections = 0
+    self.lock = threading.Lock()
+    self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+    self.kos_url = self.url + '/api/?c=json&type=unit&%s'
+
+  def count_request(self):
+    with self.lock:
+      self.requests += 1
+
+  def count_connection(self):
+    with self.lock:
+      self.connections += 1
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+
+class LogWriter(threading.Thread):
+  """Appends xxx reports to a UTF-16 chat log at a steady rate.
+
+  Each report carries its sequence number as a comment, and the time it
+  was written is kept in self.written[sequence number]. With a lead, the
+  reported pilots each say something that many seconds beforehand.
+  """
+
+  def __init__(self, filename, reports, rate, lead=0.0):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.filename = filename
+    self.reports = reports
+    self.rate = rate
+    self.lead = lead
+    self.written = {}
+
+  def run(self):
+    events = [(self.lead + seq / self.rate, True, seq)
+              for seq in range(len(self.reports))]
+    if self.lead:
+      events.extend((seq / self.rate, False, seq)
+                    for seq in range(len(self.reports)))
+    start = time.time()
+    with io.open(self.filename, 'ab', buffering=0) as log:
+      for when, report, seq in sorted(events):
+        delay = start + when - time.time()
+        if delay > 0:
+          time.sleep(delay)
+        pilots = self.reports[seq]
+        if report:
+          lines = [chat_line(datetime.datetime.now(), 'Scout Pilot',
+                             'xxx %s # seq %d' % ('  '.join(pilots), seq))]
+          self.written[seq] = time.time()
+        else:
+          lines = [chat_line(datetime.datetime.now(), pilot, 'o7')
+                   for pilot in pilots]
+        log.write(u''.join(lines).encode('utf-16-le'))
+
+
+def new_log(directory):
+  filename = os.path.join(directory, datetime.datetime.now().strftime(
+      'Fleet_%Y%m%d_%H%M%S.txt'))
+  with open(filename, 'ab') as log:
+    log.write(codecs.BOM_UTF16_LE)
+  return filename
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  if not values:
+    return float('nan')
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_reports(checker, directory, reports, rate, timeout=30.0, lead=0.0):
+  """Tails directory while a LogWriter writes reports into it.
+
+  With a lead, the pilots speak that long before being reported, and
+  everyone who speaks is prefetched.
+
+  @returns: (seconds from write to verdict for each report, elapsed time)
+  """
+  filename = new_log(directory)
+  prefetcher = ChatKosLookup.Prefetcher(checker) if lead else None
+  tailer = ChatKosLookup.DirectoryTailer(
+      directory, stats=checker.stats,
+      on_speaker=prefetcher.add if prefetcher else None)
+  writer = LogWriter(filename, reports, rate, lead)
+  latencies = []
+  start = last_progress = time.time()
+  writer.start()
+  try:
+    while len(latencies) < len(reports):
+      if time.time() - last_progress > timeout:
+        raise RuntimeError('timed out with %d of %d reports checked' % (
+            len(latencies), len(reports)))
+      tailer.wait(0.1)
+      for entry in iter(tailer.poll, None):
+        checker.koscheck_logentry(entry.pilots)
+        seq = int(entry.linekey[4].split()[1])
+        latencies.append(time.time() - writer.written[seq])
+        last_progress = time.time()
+  finally:
+    tailer.close()
+    if prefetcher:
+      prefetcher.close()
+  return latencies, time.time() - start
+
+
+def print_latencies(label, latencies, elapsed, pilots, requests):
+  print '%-5s %5d reports  p50 %7.1fms  p99 %7.1fms  max %7.1fms  ' \
+        '%7.1f pilots/s  %5d requests' % (
+            label, len(latencies), 1000 * percentile(latencies, 0.5),
+            1000 * percentile(latencies, 0.99), 1000 * max(latencies),
+            pilots / elapsed, requests)
+
+
+def bench_latency(args):
+  server = StandInServer(args.latency).start()
+  directory = tempfile.mkdtemp()
+  cache_dir = tempfile.mkdtemp()
+  rand = random.Random(0)
+  reports = [[pilot_name(rand.randint(0, args.population - 1))
+              for _ in range(args.pilots)]
+             for _ in range(args.reports)]
+  pilots = args.reports * args.pilots
+  stats = KosStats.Stats(enabled=args.stats)
+  try:
+    scheduler = KosHttp.Scheduler(rate=args.rate_limit or None, stats=stats)
+    checker = ChatKosLookup.KosChecker(stats=stats,
+        http=KosHttp.HttpPool(stats=stats, scheduler=scheduler),
+        max_workers=args.workers,
+        cache_file=os.path.join(cache_dir, 'koscheck'),
+        kos_url=server.kos_url, api_base_url=server.url)
+    print 'server latency %.0fms, %d pilots per report, %.1f reports/s' % (
+        1000 * args.latency, args.pilots, args.rate)
+    if args.prefetch_lead:
+      print 'pilots speak %.1fs before being reported' % args.prefetch_lead
+    for label in ('cold', 'warm'):
+      requests = server.requests
+      latencies, elapsed = run_reports(checker, directory, reports, args.rate,
+                                       lead=args.prefetch_lead)
+      print_latencies(label, latencies, elapsed, pilots,
+                      server.requests - requests)
+      if args.stats:
+        print stats.format()
+        stats.reset()
+  finally:
+    server.shutdown()
+    shutil.rmtree(directory)
+    shutil.rmtree(cache_dir)
+
+
+def bench_http(args):
+  """Times uncached KOS and EVE API lookups with and without keep-alive."""
+  server = StandInServer(args.latency, handshake=args.handshake).start()
+  cache_dir = tempfile.mkdtemp()
+  print 'server latency %.0fms, connection setup %.0fms, %d pilots' % (
+      1000 * args.latency, 1000 * args.handshake, args.pilots)
+  try:
+    for label, max_idle in (('fresh', 0), ('pooled', KosHttp.MAX_IDLE_PER_HOST)):
+      checker = ChatKosLookup.KosChecker(
+          max_workers=args.workers, http=KosHttp.HttpPool(max_idle=max_idle),
+          cache_file=os.path.join(cache_dir, label),
+          kos_url=server.kos_url, api_base_url=server.url)
+      names = [pilot_name(i) for i in range(args.pilots)]
+      requests, connections = server.requests, server.connections
+      latencies = []
+      start = time.time()
+      for name in names:
+        begin = time.time()
+        checker.koscheck_uncached(name)
+        latencies.append(time.time() - begin)
+      elapsed = time.time() - start
+      checker.http.close()
+      print '%-6s p50 %7.1fms  p99 %7.1fms  %7.1f pilots/s  ' \
+            '%5d requests  %5d connections' % (
+                label, 1000 * percentile(latencies, 0.5),
+                1000 * percentile(latencies, 0.99), len(names) / elapsed,
+                server.requests - requests, server.connections - connections)
+  finally:
+    server.shutdown()
+    shutil.rmtree(cache_dir)
+
+
+def legacy_scan(path):
+  """DirectoryTailer's startup as it was: stat every log, open the recent."""
+  mtime = os.stat(path).st_mtime
+  tailers = []
+  for name in os.listdir(path):
+    filename = os.path.join(path, name)
+    if abs(mtime - os.stat(filename).st_mtime) < ChatKosLookup.LOG_WINDOW:
+      tailers.append(ChatKosLookup.FileTailer(filename))
+  for tailer in tailers:
+    for _answer in iter(tailer.poll, None):
+      pass
+  return tailers
+
+
+def make_logs(directory, count, recent, seed=0):
+  """Writes count empty logs, recent of them from the last day.
+
+  The rest are spread over the three years before that, each last
+  written a little while after the time in its name.
+  """
+  rand = random.Random(seed)
+  now = time.time()
+  channels = ('Local', 'Fleet', 'Corp', 'Alliance', 'Help')
+  for i in xrange(count):
+    if i < recent:
+      started = now - rand.uniform(0, ChatKosLookup.LOG_WINDOW / 2)
+    else:
+      started = now - rand.uniform(2, 3 * 365) * 24 * 60 * 60
+    filename = os.path.join(directory, '%s_%s_%d.txt' % (
+        rand.choice(channels),
+        time.strftime('%Y%m%d_%H%M%S', time.gmtime(started)), i))
+    with open(filename, 'wb') as log:
+      log.write(codecs.BOM_UTF16_LE)
+    written = min(now, started + rand.uniform(0, 4 * 60 * 60))
+    os.utime(filename, (written, written))
+
+
+def bench_scan(args):
+  directory = tempfile.mkdtemp()
+  try:
+    make_logs(directory, args.logs, args.recent)
+    print '%d logs, %d from the last day, listed with %s' % (
+        args.logs, args.recent,
+        'scandir' if ChatKosLookup.scandir else 'listdir')
+    for label, scan in (
+        ('stat all, open recent (before)', legacy_scan),
+        ('DirectoryTailer (after)',
+         lambda path: ChatKosLookup.DirectoryTailer(
+             path, notifier=ChatLogWatcher.PollingWatcher(path)))):
+      times = []
+      for _ in range(args.repeat):
+        start = time.time()
+        result = scan(directory)
+        times.append(time.time() - start)
+        if isinstance(result, ChatKosLookup.DirectoryTailer):
+          counts = result.counts()
+          result.close()
+        else:
+          counts = {'watched': len(result), 'open': len(result)}
+          for tailer in result:
+            tailer.close()
+      print '%-32s %8.1fms  %4d watched, %4d open' % (
+          label, 1000 * min(times), counts['watched'], counts['open'])
+  finally:
+    shutil.rmtree(directory)
+
+
+def serve_standin(args):
+  server = StandInServer(args.latency, args.port, args.handshake)
+  print 'KOS stand-in: %s' % server.kos_url
+  print 'EVE API stand-in: %s' % server.url
+  server.serve_forever()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  commands = parser.add_subparsers()
+
+  parse = commands.add_parser('parser', help='chat log parsing throughput')
+  parse.add_argument('--lines', type=int, default=200000)
+  parse.add_argument('--report-every', type=int, default=100)
+  parse.set_defaults(func=bench_parser)
+
+  latency = commands.add_parser('latency', help='end to end lookup latency')
+  latency.add_argument('--latency', type=float, default=0.05,
+                       help='stand-in server response time in seconds')
+  latency.add_argument('--rate', type=float, default=5.0,
+                       help='reports written per second')
+  latency.add_argument('--reports', type=int, default=50)
+  latency.add_argument('--pilots', type=int, default=5,
+                       help='pilots named in each report')
+  latency.add_argument('--population', type=int, default=500,
+                       help='number of distinct pilots to pick from')
+  latency.add_argument('--workers', type=int,
+                       default=ChatKosLookup.DEFAULT_WORKERS)
+  latency.add_argument('--stats', action='store_true',
+                       help='print per-stage timings after each run')
+  latency.add_argument('--rate-limit', type=float,
+                       default=KosHttp.DEFAULT_RATE,
+                       help='requests per second let through, 0 for no limit')
+  latency.add_argument('--prefetch-lead', type=float, default=0.0,
+                       help='seconds pilots speak before being reported, '
+                       'prefetching everyone who speaks')
+  latency.set_defaults(func=bench_latency)
+
+  http = commands.add_parser('http', help='connection reuse')
+  http.add_argument('--latency', type=float, default=0.005,
+                    help='stand-in server response time in seconds')
+  http.add_argument('--handshake', type=float, default=0.03,
+                    help='stand-in connection setup time in seconds')
+  http.add_argument('--pilots', type=int, default=100)
+  http.add_argument('--workers', type=int,
+                    default=ChatKosLookup.DEFAULT_WORKERS)
+  http.set_defaults(func=bench_http)
+
+  standin = commands.add_parser('standin', help='run the stand-in server')
+  standin.add_argument('--latency', type=float, default=0.05)
+  standin.add_argument('--handshake', type=float, default=0.0)
+  standin.add_argument('--port', type=int, default=8080)
+  standin.set_defaults(func=serve_standin)
+
+  scan = commands.add_parser('scan', help='startup scan of a logs directory')
+  scan.add_argument('--logs', type=int, default=50000)
+  scan.add_argument('--recent', type=int, default=20,
+                    help='logs written in the last day')
+  scan.add_argument('--repeat', type=int, default=3,
+                    help='best of this many runs')
+  scan.set_defaults(func=bench_scan)
+
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,235 @@
+"""Caches shared by the KOS and standings checkers."""
+
+import collections
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+
+from evelink import api
+from evelink.cache.sqlite import SqliteCache
+
+import KosStats
+
+# Entries kept in memory in front of the sqlite cache.
+DEFAULT_MEMORY_SIZE = 2000
+
+# A cached value that may still be served for a while once it goes stale.
+Stamped = collections.namedtuple('Stamped', 'value fresh_until')
+
+
+class SharedSqliteCache(SqliteCache):
+  """A SqliteCache that can be used from several threads at once."""
+
+  def __init__(self, path):
+    SqliteCache.__init__(self, path)
+    # sqlite connections refuse to be used outside the thread that made them.
+    self.connection.close()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    result = self.get_with_expiration(key)
+    if result:
+      return result[0]
+    return None
+
+  def get_with_expiration(self, key):
+    """Like get, but returns (value, expiration) so callers can re-cache."""
+    with self.lock:
+      cursor = self.connection.cursor()
+      cursor.execute('select value, expiration from cache where "key"=?',
+                     (key,))
+      result = cursor.fetchone()
+      if not result:
+        cursor.close()
+        return None
+      value, expiration = result
+      if expiration < time.time():
+        cursor.execute('delete from cache where "key"=?', (key,))
+        self.connection.commit()
+        cursor.close()
+        return None
+      cursor.close()
+    return pickle.loads(str(value)), expiration
+
+  def put(self, key, value, duration):
+    with self.lock:
+      SqliteCache.put(self, key, value, duration)
+
+
+class StampedCache(api.APICache):
+  """An APICache that can also serve entries for a while after they expire.
+
+  Subclasses provide get and put.
+  """
+
+  def put_stamped(self, key, value, ttl, grace=0):
+    """Caches value as fresh for ttl seconds, then as stale for grace more."""
+    self.put(key, Stamped(value, time.time() + ttl), ttl + grace)
+
+  def get_stamped(self, key):
+    """Returns (value, whether it is stale), or None if nothing is cached."""
+    cached = self.get(key)
+    if cached is None:
+      return None
+    if isinstance(cached, Stamped):
+      return cached.value, cached.fresh_until < time.time()
+    # Cached without a stamp, e.g. by an older version.
+    return cached, False
+
+
+class MemoryCache(StampedCache):
+  """A size-bounded in-process LRU cache whose entries expire."""
+
+  def __init__(self, max_size=DEFAULT_MEMORY_SIZE):
+    StampedCache.__init__(self)
+    self.max_size = max_size
+    self.cache = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key):
+    with self.lock:
+      result = self.cache.pop(key, None)
+      if result is None:
+        self.misses += 1
+        return None
+      value, expiration = result
+      if expiration < time.time():
+        self.expirations += 1
+        self.misses += 1
+        return None
+      # Re-inserting moves the entry to the most recently used end.
+      self.cache[key] = result
+      self.hits += 1
+      return value
+
+  def put(self, key, value, duration):
+    self.put_until(key, value, time.time() + duration)
+
+  def put_until(self, key, value, expiration):
+    with self.lock:
+      self.cache.pop(key, None)
+      self.cache[key] = (value, expiration)
+      while len(self.cache) > self.max_size:
+        self.cache.popitem(last=False)
+        self.evictions += 1
+
+  def stats(self):
+    """Returns the hit/miss/eviction counters and the current size."""
+    with self.lock:
+      return {
+          'size': len(self.cache),
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'expirations': self.expirations,
+      }
+
+
+class TieredCache(StampedCache):
+  """Answers from a MemoryCache, falling back to a SharedSqliteCache.
+
+  Values found in sqlite are copied into memory for the rest of their
+  lifetime, so hot keys skip sqlite and unpickling entirely.
+  """
+
+  def __init__(self, backing, memory=None, timings=KosStats.DISABLED):
+    StampedCache.__init__(self)
+    self.backing = backing
+    self.memory = memory or MemoryCache()
+    self.timings = timings
+
+  def get(self, key):
+    value = self.memory.get(key)
+    if value is not None:
+      return value
+    with self.timings.timer('sqlite_get'):
+      result = self.backing.get_with_expiration(key)
+    if not result:
+      return None
+    value, expiration = result
+    self.memory.put_until(key, value, expiration)
+    return value
+
+  def put(self, key, value, duration):
+    self.memory.put(key, value, duration)
+    with self.timings.timer('sqlite_put'):
+      self.backing.put(key, value, duration)
+
+  def stats(self):
+    return self.memory.stats()
+
+
+class SingleFlight:
+  """Coalesces concurrent calls for the same key into one.
+
+  The first caller for a key runs the function; anyone asking for the
+  same key meanwhile waits for and shares its result (or exception).
+  """
+
+  def __init__(self, timings=KosStats.DISABLED):
+    self.lock = threading.Lock()
+    self.calls = {}
+    self.timings = timings
+
+  def do(self, key, func, *args):
+    with self.lock:
+      call = self.calls.get(key)
+      if call is None:
+        call = self.calls[key] = _Call()
+        leader = True
+      else:
+        leader = False
+    if not leader:
+      self.timings.increment('coalesced')
+      call.done.wait()
+      if call.exc_info:
+        raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+      return call.result
+
+    try:
+      call.result = func(*args)
+      return call.result
+    except:
+      call.exc_info = sys.exc_info()
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+      call.done.set()
+
+
+class _Call:
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exc_info = None
+
+
+class RecentSet:
+  """A set that only remembers its most recently added max_size keys."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.keys = collections.OrderedDict()
+
+  def __contains__(self, key):
+    return key in self.keys
+
+  def __len__(self):
+    return len(self.keys)
+
+  def add(self, key):
+    """Adds key, returning False if it was already present."""
+    if key in self.keys:
+      return False
+    self.keys[key] = True
+    if len(self.keys) > self.max_size:
+      self.keys.popitem(last=False)
+    return True
@@ -0,0 +1,138 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append('evelink-api')
+
+import KosCache
+
+
+class TestMemoryCache(unittest.TestCase):
+  def test_get_put(self):
+    cache = KosCache.MemoryCache(10)
+    self.assertEquals(cache.get('a'), None)
+    cache.put('a', 1, 60)
+    self.assertEquals(cache.get('a'), 1)
+    self.assertEquals(cache.stats()['hits'], 1)
+    self.assertEquals(cache.stats()['misses'], 1)
+
+  def test_expiry(self):
+    cache = KosCache.MemoryCache(10)
+    cache.put('a', 1, -1)
+    self.assertEquals(cache.get('a'), None)
+    self.assertEquals(cache.stats()['expirations'], 1)
+    self.assertEquals(cache.stats()['size'], 0)
+
+  def test_lru_eviction(self):
+    cache = KosCache.MemoryCache(2)
+    cache.put('a', 1, 60)
+    cache.put('b', 2, 60)
+    cache.get('a')
+    cache.put('c', 3, 60)
+    self.assertEquals(cache.get('b'), None)
+    self.assertEquals(cache.get('a'), 1)
+    self.assertEquals(cache.get('c'), 3)
+    self.assertEquals(cache.stats()['evictions'], 1)
+
+  def test_stamped(self):
+    cache = KosCache.MemoryCache(10)
+    self.assertEquals(cache.get_stamped('a'), None)
+    cache.put_stamped('a', 1, 60, 60)
+    self.assertEquals(cache.get_stamped('a'), (1, False))
+    cache.put_stamped('a', 2, -1, 60)
+    self.assertEquals(cache.get_stamped('a'), (2, True))
+    cache.put_stamped('a', 3, -2, 1)
+    self.assertEquals(cache.get_stamped('a'), None)
+    cache.put('b', 4, 60)
+    self.assertEquals(cache.get_stamped('b'), (4, False))
+
+
+class TestTieredCache(unittest.TestCase):
+  def setUp(self):
+    self.tmpfile = tempfile.mktemp()
+    self.backing = KosCache.SharedSqliteCache(self.tmpfile)
+
+  def test_promotes_from_sqlite(self):
+    self.backing.put('a', {'results': []}, 60)
+    cache = KosCache.TieredCache(self.backing)
+    self.assertEquals(cache.get('a'), {'results': []})
+    self.backing.connection.execute('delete from cache')
+    self.assertEquals(cache.get('a'), {'results': []})
+    self.assertEquals(cache.stats()['hits'], 1)
+
+  def test_promoted_entries_keep_expiry(self):
+    self.backing.put('a', 1, 60)
+    cache = KosCache.TieredCache(self.backing)
+    cache.get('a')
+    value, expiration = cache.memory.cache['a']
+    self.assertTrue(expiration <= time.time() + 60)
+
+  def test_stamped_survives_sqlite(self):
+    KosCache.TieredCache(self.backing).put_stamped('a', [1], -1, 60)
+    self.assertEquals(KosCache.TieredCache(self.backing).get_stamped('a'),
+                      ([1], True))
+
+  def test_put_writes_through(self):
+    cache = KosCache.TieredCache(self.backing)
+    cache.put('a', 1, 60)
+    self.assertEquals(self.backing.get('a'), 1)
+
+  def tearDown(self):
+    self.backing.connection.close()
+    os.unlink(self.tmpfile)
+
+
+class TestSingleFlight(unittest.TestCase):
+  def test_coalesces(self):
+    flight = KosCache.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def slow(value):
+      calls.append(value)
+      started.set()
+      release.wait()
+      return value * 2
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flight.do('k', slow, 1)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(
+        target=lambda: results.append(flight.do('k', slow, 5)))
+        for _ in range(3)]
+    for t in followers:
+      t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in [leader] + followers:
+      t.join()
+    self.assertEquals(calls, [1])
+    self.assertEquals(results, [2, 2, 2, 2])
+    self.assertEquals(flight.do('k', slow, 5), 10)
+
+  def test_exception_clears_call(self):
+    flight = KosCache.SingleFlight()
+    def fail():
+      raise ValueError()
+    self.assertRaises(ValueError, flight.do, 'k', fail)
+    self.assertEquals(flight.calls, {})
+
+
+class TestRecentSet(unittest.TestCase):
+  def test_bounded(self):
+    recent = KosCache.RecentSet(2)
+    self.assertTrue(recent.add('a'))
+    self.assertFalse(recent.add('a'))
+    recent.add('b')
+    recent.add('c')
+    self.assertFalse('a' in recent)
+    self.assertTrue('c' in recent)
+    self.assertEquals(len(recent), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,316 @@
+"""A small keep-alive HTTP client shared by the KOS and EVE API lookups.
+
+urllib2 opens (and for https, negotiates) a new connection for every
+request. HttpPool keeps idle connections per host and hands them out
+again, asks for gzip'd responses, and applies separate connect and read
+timeouts:
+
+  http = KosHttp.HttpPool()
+  body = http.request('http://kos.cva-eve.org/api/?c=json&q=Pilot')
+
+Errors are raised as urllib2.HTTPError / urllib2.URLError so callers
+written against urllib2 keep working.
+
+Given a Scheduler, the pool also waits its turn before each request:
+requests are admitted in priority order under a token-bucket rate
+limit, and everything backs off while the servers are failing. The
+priority comes from the calling thread:
+
+  with KosHttp.priority(KosHttp.BULK):
+    ...  # e.g. a standings audit
+"""
+
+import contextlib
+import errno
+import heapq
+import httplib
+import io
+import itertools
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+
+import KosStats
+
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 30.0
+# Idle connections kept per (scheme, host, port).
+MAX_IDLE_PER_HOST = 8
+USER_AGENT = 'KosLookup'
+
+# Request priorities, most urgent first: lookups someone is waiting for,
+# lookups made ahead of time, and audits of whole lists.
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+PRIORITY_NAMES = ('interactive', 'background', 'bulk')
+# Requests per second let through on average, and how many may go at once
+# after a quiet spell.
+DEFAULT_RATE = 30.0
+DEFAULT_BURST = 60
+# Pause after the first of a run of failures, doubling up to the maximum.
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 15.0
+
+# Raised when a kept-alive connection turns out to have been closed.
+_STALE_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest)
+_STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+_context = threading.local()
+
+
+def _is_stale(e):
+  """Whether e means the server had closed the connection before we sent.
+
+  Timeouts and other socket errors aren't, as the request may well have
+  reached the server; retrying those would only double the wait.
+  """
+  if isinstance(e, _STALE_ERRORS):
+    return True
+  return (isinstance(e, socket.error) and not isinstance(e, socket.timeout)
+          and e.errno in _STALE_ERRNOS)
+
+
+def current_priority():
+  """The priority of requests made by this thread; INTERACTIVE by default."""
+  return getattr(_context, 'priority', INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level):
+  """Makes requests from this thread at the given priority."""
+  old = current_priority()
+  _context.priority = level
+  try:
+    yield
+  finally:
+    _context.priority = old
+
+
+def bind_priority(func):
+  """Wraps func to run at the caller's priority, e.g. on a worker thread."""
+  level = current_priority()
+  def run(*args, **kwargs):
+    with priority(level):
+      return func(*args, **kwargs)
+  return run
+
+
+class Scheduler:
+  """Admits requests one at a time by priority, then first come first served.
+
+  A request goes once it is at the front of the queue, a token is
+  available, and no backoff is in force. Tokens refill at rate per second
+  up to burst; a rate of None means no limit. Each failure reported
+  pauses everyone for twice as long as the last, up to BACKOFF_MAX, or
+  for as long as the server's Retry-After asks; a success resets that.
+  """
+
+  def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+               stats=KosStats.DISABLED):
+    self.rate = rate
+    self.burst = burst
+    self.stats = stats
+    self.cond = threading.Condition()
+    self.tokens = float(burst)
+    self.refilled = time.time()
+    self.waiting = []
+    self.sequence = itertools.count()
+    self.penalty = 0.0
+    self.backoff_until = 0.0
+
+  def acquire(self, level=INTERACTIVE):
+    """Blocks until a request at this priority may be sent."""
+    start = time.time()
+    with self.cond:
+      ticket = (level, next(self.sequence))
+      heapq.heappush(self.waiting, ticket)
+      while True:
+        now = time.time()
+        self._refill(now)
+        if self.waiting[0] == ticket:
+          delay = self.backoff_until - now
+          if self.rate:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+          if delay <= 0:
+            break
+        else:
+          # Woken when the requests ahead of this one have gone.
+          delay = None
+        self.cond.wait(delay)
+      heapq.heappop(self.waiting)
+      if self.rate:
+        self.tokens -= 1
+      self.cond.notify_all()
+    self.stats.record('wait_' + PRIORITY_NAMES[level], time.time() - start)
+
+  def report(self, ok, retry_after=None):
+    """Records how a request went, backing off after failures."""
+    with self.cond:
+      if ok:
+        self.penalty = 0.0
+        return
+      self.penalty = min(max(2 * self.penalty, BACKOFF_MIN), BACKOFF_MAX)
+      self.backoff_until = max(self.backoff_until,
+                               time.time() + max(self.penalty, retry_after or 0))
+      self.cond.notify_all()
+    self.stats.increment('http_backoff')
+
+  def snapshot(self):
+    """Returns the queue depth per priority, tokens left and backoff."""
+    with self.cond:
+      queued = dict((name, 0) for name in PRIORITY_NAMES)
+      for (level, _) in self.waiting:
+        queued[PRIORITY_NAMES[level]] += 1
+      self._refill(time.time())
+      return {
+          'queued': queued,
+          'tokens': self.tokens if self.rate else None,
+          'backoff': max(0.0, self.backoff_until - time.time()),
+      }
+
+  def _refill(self, now):
+    if self.rate:
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.refilled) * self.rate)
+    self.refilled = now
+
+
+def _retry_after(headers):
+  """Seconds asked for by a Retry-After header, if it gives a number."""
+  value = headers and headers.getheader('retry-after')
+  if value and value.strip().isdigit():
+    return float(value)
+  return None
+
+
+class HttpPool:
+  """Thread-safe pool of keep-alive HTTP and HTTPS connections."""
+
+  def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+               read_timeout=READ_TIMEOUT, max_idle=MAX_IDLE_PER_HOST,
+               stats=KosStats.DISABLED, scheduler=None):
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    # With max_idle=0 every request gets a fresh connection, like urllib2.
+    self.max_idle = max_idle
+    self.stats = stats
+    # Paces requests if given; see Scheduler.
+    self.scheduler = scheduler
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def request(self, url, data=None, headers=None):
+    """Fetches url, POSTing data if given, with any extra headers.
+
+    @returns: the (decompressed) response body.
+    """
+    if self.scheduler is None:
+      return self._request(url, data, headers)
+    self.scheduler.acquire(current_priority())
+    try:
+      body = self._request(url, data, headers)
+    except urllib2.HTTPError as e:
+      # Only overload and server errors say to slow down.
+      self.scheduler.report(e.code < 500 and e.code != 429,
+                            _retry_after(e.hdrs))
+      raise
+    except urllib2.URLError:
+      self.scheduler.report(False)
+      raise
+    self.scheduler.report(True)
+    return body
+
+  def _request(self, url, data, extra_headers=None):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+      raise urllib2.URLError('unsupported URL scheme: %s' % url)
+    key = (parts.scheme, parts.hostname,
+           parts.port or (443 if parts.scheme == 'https' else 80))
+    path = parts.path or '/'
+    if parts.query:
+      path += '?' + parts.query
+    headers = {'Accept-Encoding': 'gzip', 'User-Agent': USER_AGENT}
+    if data is not None:
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    headers.update(extra_headers or {})
+    method = 'GET' if data is None else 'POST'
+
+    conn = self._checkout(key)
+    try:
+      try:
+        response = self._send(conn, method, path, data, headers)
+      except (socket.error, httplib.HTTPException) as e:
+        if not conn.reused or not _is_stale(e):
+          raise
+        # The server dropped the idle connection; try once on a new one.
+        conn.close()
+        conn = self._connect(key)
+        response = self._send(conn, method, path, data, headers)
+      body = response.read()
+    except (socket.error, httplib.HTTPException) as e:
+      conn.close()
+      raise urllib2.URLError(e)
+
+    if response.will_close:
+      conn.close()
+    else:
+      self._checkin(key, conn)
+
+    if response.getheader('content-encoding', '').lower() == 'gzip':
+      body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if response.status >= 400:
+      raise urllib2.HTTPError(url, response.status, response.reason,
+                              response.msg, io.BytesIO(body))
+    return body
+
+  def close(self):
+    """Closes every idle connection."""
+    with self.lock:
+      idle, self.idle = self.idle, {}
+    for conns in idle.itervalues():
+      for conn in conns:
+        conn.close()
+
+  def _send(self, conn, method, path, data, headers):
+    if conn.sock is None:
+      with self.stats.timer('http_connect'):
+        conn.connect()
+      conn.sock.settimeout(self.read_timeout)
+      # Requests are small and sent whole, so don't let Nagle's algorithm
+      # hold them back waiting for the ACK of the previous response.
+      conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.request(method, path, data, headers)
+    return conn.getresponse()
+
+  def _checkout(self, key):
+    with self.lock:
+      conns = self.idle.get(key)
+      if conns:
+        conn = conns.pop()
+        conn.reused = True
+        self.stats.increment('http_reused')
+        return conn
+    return self._connect(key)
+
+  def _connect(self, key):
+    scheme, host, port = key
+    if scheme == 'https':
+      conn = httplib.HTTPSConnection(host, port, timeout=self.connect_timeout)
+    else:
+      conn = httplib.HTTPConnection(host, port, timeout=self.connect_timeout)
+    conn.reused = False
+    self.stats.increment('http_connections')
+    return conn
+
+  def _checkin(self, key, conn):
+    with self.lock:
+      conns = self.idle.setdefault(key, [])
+      if len(conns) < self.max_idle:
+        conns.append(conn)
+        return
+    conn.close()
@@ -0,0 +1,193 @@
+import BaseHTTPServer
+import gzip
+import io
+import SocketServer
+import threading
+import time
+import unittest
+import urllib2
+
+import KosHttp
+import KosStats
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    self.server.connections += 1
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+  def do_GET(self):
+    self.server.requests += 1
+    if self.path.endswith('slow'):
+      time.sleep(0.3)
+    self.respond(self.path)
+    if self.path.endswith('drop'):
+      # Keep-alive was offered, but the connection goes anyway.
+      self.close_connection = 1
+
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length'))
+    self.respond(self.rfile.read(length))
+
+  def respond(self, body):
+    status = 404 if body.endswith('missing') else 200
+    if body.endswith('busy'):
+      status = 503
+    self.send_response(status)
+    if 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+      compressed = io.BytesIO()
+      with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+        f.write(body)
+      body = compressed.getvalue()
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    if self.path.endswith('close'):
+      self.send_header('Connection', 'close')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  connections = 0
+  requests = 0
+
+
+class TestHttpPool(unittest.TestCase):
+  def setUp(self):
+    self.server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.http = KosHttp.HttpPool()
+
+  def test_reuses_connection(self):
+    self.assertEquals(self.http.request(self.url + '/a?b=c'), '/a?b=c')
+    self.assertEquals(self.http.request(self.url + '/d'), '/d')
+    self.assertEquals(self.http.request(self.url + '/e', 'x=1'), 'x=1')
+    self.assertEquals(self.server.connections, 1)
+
+  def test_no_reuse(self):
+    http = KosHttp.HttpPool(max_idle=0)
+    http.request(self.url + '/a')
+    http.request(self.url + '/b')
+    self.assertEquals(self.server.connections, 2)
+
+  def test_connection_close(self):
+    self.http.request(self.url + '/close')
+    self.http.request(self.url + '/close')
+    self.assertEquals(self.server.connections, 2)
+
+  def test_stale_connection_retried(self):
+    # Mimics the server timing out the idle connection.
+    self.http.request(self.url + '/drop')
+    time.sleep(0.05)
+    self.assertEquals(self.http.request(self.url + '/b'), '/b')
+    self.assertEquals(self.server.connections, 2)
+
+  def test_timeout_not_retried(self):
+    http = KosHttp.HttpPool(read_timeout=0.1)
+    http.request(self.url + '/a')
+    self.assertRaises(urllib2.URLError, http.request, self.url + '/slow')
+    self.assertEquals(self.server.requests, 2)
+
+  def test_http_error(self):
+    try:
+      self.http.request(self.url + '/missing')
+      self.fail()
+    except urllib2.HTTPError as e:
+      self.assertEquals(e.code, 404)
+      self.assertEquals(e.read(), '/missing')
+    self.assertEquals(self.http.request(self.url + '/a'), '/a')
+    self.assertEquals(self.server.connections, 1)
+
+  def test_connection_refused(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.assertRaises(urllib2.URLError, KosHttp.HttpPool().request,
+                      self.url + '/a')
+
+  def test_server_errors_back_off(self):
+    scheduler = KosHttp.Scheduler(rate=None)
+    http = KosHttp.HttpPool(scheduler=scheduler)
+    self.assertRaises(urllib2.HTTPError, http.request, self.url + '/missing')
+    self.assertEquals(scheduler.snapshot()['backoff'], 0.0)
+    self.assertRaises(urllib2.HTTPError, http.request, self.url + '/busy')
+    self.assertTrue(scheduler.snapshot()['backoff'] > 0)
+    http.close()
+
+  def tearDown(self):
+    self.http.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+
+class TestScheduler(unittest.TestCase):
+  def test_rate_limit(self):
+    scheduler = KosHttp.Scheduler(rate=100.0, burst=2)
+    start = time.time()
+    for _ in range(6):
+      scheduler.acquire()
+    # Two go at once, the other four at 10ms intervals.
+    self.assertTrue(0.03 <= time.time() - start < 0.5)
+
+  def test_priority_order(self):
+    scheduler = KosHttp.Scheduler(rate=50.0, burst=1)
+    scheduler.acquire()
+    order = []
+    def request(level, name):
+      scheduler.acquire(level)
+      order.append(name)
+    threads = []
+    for (level, name) in ((KosHttp.BULK, 'bulk'),
+                          (KosHttp.BACKGROUND, 'background'),
+                          (KosHttp.INTERACTIVE, 'interactive')):
+      threads.append(threading.Thread(target=request, args=(level, name)))
+      threads[-1].start()
+      time.sleep(0.002)
+    self.assertEquals(sum(scheduler.snapshot()['queued'].values()), 3)
+    for thread in threads:
+      thread.join(5)
+    self.assertEquals(order, ['interactive', 'background', 'bulk'])
+
+  def test_backoff(self):
+    stats = KosStats.Stats()
+    scheduler = KosHttp.Scheduler(rate=None, stats=stats)
+    scheduler.report(False)
+    scheduler.report(False)
+    self.assertEquals(scheduler.penalty, 2 * KosHttp.BACKOFF_MIN)
+    scheduler.backoff_until = time.time() + 0.05
+    start = time.time()
+    scheduler.acquire()
+    self.assertTrue(time.time() - start >= 0.04)
+    scheduler.report(True)
+    self.assertEquals(scheduler.penalty, 0.0)
+    self.assertEquals(stats.snapshot()['counters']['http_backoff'], 2)
+    self.assertEquals(stats.snapshot()['stages']['wait_interactive']['count'],
+                      1)
+
+  def test_retry_after(self):
+    scheduler = KosHttp.Scheduler(rate=None)
+    scheduler.report(False, retry_after=10)
+    self.assertTrue(scheduler.snapshot()['backoff'] > 9)
+
+  def test_priority_context(self):
+    self.assertEquals(KosHttp.current_priority(), KosHttp.INTERACTIVE)
+    with KosHttp.priority(KosHttp.BULK):
+      bound = KosHttp.bind_priority(KosHttp.current_priority)
+    self.assertEquals(KosHttp.current_priority(), KosHttp.INTERACTIVE)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(bound()))
+    thread.start()
+    thread.join()
+    self.assertEquals(result, [KosHttp.BULK])
+
+
+if __name__ == '__main__':
+  unittest.main()
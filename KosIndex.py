@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""A local, memory-mapped index of KOS pilots, corps and alliances.
+
+Usage: KosIndex.py build koscheck.idx export.json [more.json...]
+       KosIndex.py find koscheck.idx 'Pilot Name'
+
+Exports are in the KOS site's JSON format, either {'results': [unit...]}
+or a plain list of units, where each unit may nest its 'corp' and that
+its 'alliance'. Every entity mentioned is stored once, linked to its
+parent, so lookups answer with the same nested units the site would.
+
+The file holds fixed-size records plus two sorted tables, one by
+lower-cased name and one by ID, so a lookup is a binary search over the
+mapped file rather than a parse of the whole export.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+
+MAGIC = 'KOSIDX01'
+# magic, entity count, then the offsets of the name table, ID table and
+# string data.
+HEADER = struct.Struct('<8sIIII')
+# id, parent record (-1 if none), label offset and length, ticker offset
+# and length, type, flags.
+RECORD = struct.Struct('<qiIHIHBB')
+NAME_ENTRY = struct.Struct('<I')
+ID_ENTRY = struct.Struct('<qI')
+
+TYPES = ('pilot', 'corp', 'alliance')
+KOS_FLAG = 1
+NPC_FLAG = 2
+TICKER_FLAG = 4
+# Parents further up than this are ignored, in case of bad data.
+MAX_DEPTH = 4
+
+
+def load_units(filename):
+  """Reads the units from a KOS site JSON export."""
+  with open(filename, 'rb') as f:
+    data = json.load(f)
+  if isinstance(data, dict):
+    data = data['results']
+  return data
+
+
+def _flatten(units):
+  """Returns {(type, lower name): (unit, parent key)} for every entity."""
+  entities = {}
+  def add(unit, depth):
+    if unit.get('type') not in TYPES or depth > MAX_DEPTH:
+      return None
+    key = (unit['type'], unit['label'].lower())
+    parent = None
+    for field in ('corp', 'alliance'):
+      if unit.get(field):
+        parent = add(unit[field], depth + 1)
+        break
+    if parent is None and key in entities:
+      # A bare mention doesn't lose a link learned elsewhere.
+      parent = entities[key][1]
+    entities[key] = (unit, parent)
+    return key
+  for unit in units:
+    add(unit, 0)
+  return entities
+
+
+def build(path, units):
+  """Writes an index of units (and their parents) next to path.
+
+  @returns: the new file's name, for the caller to rename over path.
+  """
+  entities = _flatten(units)
+  keys = sorted(entities)
+  number = dict((key, i) for i, key in enumerate(keys))
+
+  strings = []
+  string_size = [0]
+  def add_string(value):
+    data = value.encode('utf-8')
+    offset = string_size[0]
+    strings.append(data)
+    string_size[0] += len(data)
+    return offset, len(data)
+
+  records = []
+  for key in keys:
+    unit, parent = entities[key]
+    label_offset, label_len = add_string(unit['label'])
+    flags = 0
+    if unit.get('kos'):
+      flags |= KOS_FLAG
+    if unit.get('npc'):
+      flags |= NPC_FLAG
+    ticker_offset, ticker_len = 0, 0
+    if unit.get('ticker') is not None:
+      flags |= TICKER_FLAG
+      ticker_offset, ticker_len = add_string(unit['ticker'])
+    records.append(RECORD.pack(
+        int(unit.get('id') or 0), number[parent] if parent else -1,
+        label_offset, label_len, ticker_offset, ticker_len,
+        TYPES.index(unit['type']), flags))
+
+  by_name = sorted(range(len(keys)),
+                   key=lambda i: entities[keys[i]][0]['label'].lower())
+  by_id = sorted((int(entities[key][0].get('id') or 0), i)
+                 for i, key in enumerate(keys))
+  by_id = [(eid, i) for (eid, i) in by_id if eid]
+
+  names_offset = HEADER.size + RECORD.size * len(records)
+  ids_offset = names_offset + NAME_ENTRY.size * len(by_name)
+  strings_offset = ids_offset + ID_ENTRY.size * len(by_id)
+  # A name of its own, in case another build of the same index is running.
+  handle, tmp = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(path)),
+      prefix=os.path.basename(path) + '.', suffix='.tmp')
+  try:
+    with os.fdopen(handle, 'wb') as f:
+      f.write(HEADER.pack(MAGIC, len(records), names_offset, ids_offset,
+                          strings_offset))
+      f.write(''.join(records))
+      f.write(''.join(NAME_ENTRY.pack(i) for i in by_name))
+      f.write(''.join(ID_ENTRY.pack(eid, i) for (eid, i) in by_id))
+      f.write(''.join(strings))
+  except:
+    os.remove(tmp)
+    raise
+  return tmp
+
+
+class _Names:
+  """The name table as a sorted sequence of lower-cased names."""
+
+  def __init__(self, index):
+    self.index = index
+
+  def __len__(self):
+    return self.index.count
+
+  def __getitem__(self, i):
+    return self.index._label(self.index._name_record(i)).lower()
+
+
+class KosIndex:
+  """A read-only view of an index file; empty if the file doesn't exist.
+
+  Lookups are thread-safe, and replace() swaps in a new file under the
+  same lock, so readers never see a half-written or closed mapping.
+  Opening a file that isn't a complete index raises ValueError; with
+  load=False the file isn't read until the next replace().
+  """
+
+  def __init__(self, path, load=True):
+    self.path = path
+    self.lock = threading.Lock()
+    self.map = None
+    self.count = 0
+    if load:
+      self._open()
+
+  def _open(self):
+    self.map = None
+    self.count = 0
+    if not os.path.exists(self.path) or not os.path.getsize(self.path):
+      return
+    with open(self.path, 'rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self.map) < HEADER.size:
+      self._close_bad('%s is not a KOS index' % self.path)
+    (magic, count, self.names_offset, self.ids_offset,
+     self.strings_offset) = HEADER.unpack_from(self.map)
+    if magic != MAGIC:
+      self._close_bad('%s is not a KOS index' % self.path)
+    if (self.names_offset != HEADER.size + RECORD.size * count or
+        not self.names_offset <= self.ids_offset <= self.strings_offset
+        <= len(self.map)):
+      self._close_bad('%s is truncated' % self.path)
+    self.count = count
+    self.names = _Names(self)
+
+  def _close_bad(self, message):
+    self.map.close()
+    self.map = None
+    raise ValueError(message)
+
+  def close(self):
+    with self.lock:
+      if self.map:
+        self.map.close()
+      self.map = None
+      self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def find(self, name):
+    """Returns the units called name (case-insensitively), parents nested."""
+    with self.lock:
+      if not self.count:
+        return []
+      name = name.lower()
+      i = bisect.bisect_left(self.names, name)
+      units = []
+      while i < self.count and self.names[i] == name:
+        units.append(self._unit(self._name_record(i)))
+        i += 1
+      return units
+
+  def find_id(self, eid):
+    """Returns the unit with ID eid, or None."""
+    with self.lock:
+      lo, hi = 0, self._id_count()
+      while lo < hi:
+        mid = (lo + hi) // 2
+        mid_id, record = ID_ENTRY.unpack_from(
+            self.map, self.ids_offset + mid * ID_ENTRY.size)
+        if mid_id < eid:
+          lo = mid + 1
+        elif mid_id > eid:
+          hi = mid
+        else:
+          return self._unit(record)
+      return None
+
+  def units(self):
+    """Returns every entity as a unit, e.g. to merge into a new index."""
+    with self.lock:
+      return [self._unit(i) for i in range(self.count)]
+
+  def replace(self, units):
+    """Rebuilds the file from units and switches to it."""
+    tmp = build(self.path, units)
+    with self.lock:
+      # Windows won't replace a file that is still mapped.
+      if self.map:
+        self.map.close()
+      if os.path.exists(self.path):
+        os.remove(self.path)
+      os.rename(tmp, self.path)
+      self._open()
+
+  def _id_count(self):
+    if not self.count:
+      return 0
+    return (self.strings_offset - self.ids_offset) // ID_ENTRY.size
+
+  def _name_record(self, i):
+    return NAME_ENTRY.unpack_from(
+        self.map, self.names_offset + i * NAME_ENTRY.size)[0]
+
+  def _string(self, offset, length):
+    start = self.strings_offset + offset
+    return self.map[start:start + length].decode('utf-8')
+
+  def _label(self, record):
+    (eid, parent, label_offset, label_len, ticker_offset, ticker_len,
+     type_code, flags) = RECORD.unpack_from(
+         self.map, HEADER.size + record * RECORD.size)
+    return self._string(label_offset, label_len)
+
+  def _unit(self, record, depth=0):
+    (eid, parent, label_offset, label_len, ticker_offset, ticker_len,
+     type_code, flags) = RECORD.unpack_from(
+         self.map, HEADER.size + record * RECORD.size)
+    unit = {
+        'id': eid,
+        'label': self._string(label_offset, label_len),
+        'type': TYPES[type_code],
+        'kos': bool(flags & KOS_FLAG),
+        'npc': bool(flags & NPC_FLAG),
+        'ticker': None,
+    }
+    if flags & TICKER_FLAG:
+      unit['ticker'] = self._string(ticker_offset, ticker_len)
+    if parent >= 0 and depth < MAX_DEPTH:
+      parent_unit = self._unit(parent, depth + 1)
+      unit[parent_unit['type']] = parent_unit
+    return unit
+
+
+def main():
+  if len(sys.argv) >= 4 and sys.argv[1] == 'build':
+    units = []
+    for filename in sys.argv[3:]:
+      units.extend(load_units(filename))
+    index = KosIndex(sys.argv[2])
+    index.replace(units)
+    print 'Indexed %d entities into %s' % (len(index), sys.argv[2])
+  elif len(sys.argv) == 4 and sys.argv[1] == 'find':
+    index = KosIndex(sys.argv[2])
+    name = sys.argv[3].decode(sys.stdin.encoding or 'utf-8')
+    for unit in index.find(name):
+      print json.dumps(unit, indent=2, sort_keys=True)
+  else:
+    print __doc__.splitlines()[2]
+    print __doc__.splitlines()[3]
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,164 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('evelink-api')
+
+import ChatKosLookup
+import KosIndex
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'KosIndex_test.json')
+
+
+class TestKosIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'koscheck.idx')
+    self.index = KosIndex.KosIndex(self.path)
+    self.index.replace(KosIndex.load_units(FIXTURE))
+
+  def test_find(self):
+    [unit] = self.index.find('bad PILOT')
+    self.assertEquals(unit['label'], 'Bad Pilot')
+    self.assertTrue(unit['kos'])
+    self.assertEquals(unit['corp']['ticker'], 'SOME')
+    self.assertEquals(unit['corp']['alliance']['label'], 'Some Alliance')
+    self.assertEquals(self.index.find('Bad Pilo'), [])
+    self.assertEquals(self.index.find('Zzz'), [])
+
+  def test_find_id(self):
+    self.assertEquals(self.index.find_id(98000002)['label'], 'Evil Corp')
+    self.assertEquals(self.index.find_id(98000003), None)
+
+  def test_same_name(self):
+    units = self.index.find('Evil Corp')
+    self.assertEquals(sorted(u['type'] for u in units), ['alliance', 'corp'])
+
+  def test_unicode(self):
+    [unit] = self.index.find(u'pil\xf6t \xe4')
+    self.assertEquals(unit['label'], u'Pil\xf6t \xc4')
+
+  def test_missing_file(self):
+    index = KosIndex.KosIndex(os.path.join(self.tmpdir, 'missing.idx'))
+    self.assertEquals(len(index), 0)
+    self.assertEquals(index.find('Bad Pilot'), [])
+    self.assertEquals(index.find_id(90000001), None)
+
+  def test_rebuild_from_units(self):
+    count = len(self.index)
+    self.index.replace(self.index.units())
+    self.assertEquals(len(self.index), count)
+    self.assertEquals(self.index.find('Good Pilot')[0]['corp']['alliance'][
+        'label'], 'Evil Alliance')
+
+  def test_bad_files(self):
+    with open(self.path, 'rb') as f:
+      data = f.read()
+    for bad in ('', 'x' * 10, 'NOTANIDX' + data[8:], data[:len(data) // 2]):
+      path = os.path.join(self.tmpdir, 'bad.idx')
+      with open(path, 'wb') as f:
+        f.write(bad)
+      if bad:
+        self.assertRaises(ValueError, KosIndex.KosIndex, path)
+      index = KosIndex.KosIndex(path, load=False)
+      self.assertEquals(index.find('Bad Pilot'), [])
+      index.replace(self.index.units())
+      self.assertEquals(len(index), len(self.index))
+      index.close()
+
+  def test_no_tmp_files_left(self):
+    self.index.replace(self.index.units())
+    self.assertEquals(sorted(os.listdir(self.tmpdir)), ['koscheck.idx'])
+
+  def tearDown(self):
+    self.index.close()
+    shutil.rmtree(self.tmpdir)
+
+
+class FakeHttp:
+  """Answers every KOS site query with no results."""
+
+  def __init__(self):
+    self.requests = []
+
+  def request(self, url, data=None):
+    self.requests.append(url)
+    return json.dumps({'results': []})
+
+
+class TestCheckerIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.http = FakeHttp()
+    self.checker = ChatKosLookup.KosChecker(
+        cache_file=os.path.join(self.tmpdir, 'koscheck'), http=self.http)
+    self.checker.index.replace(KosIndex.load_units(FIXTURE))
+
+  def wait_for_refresh(self):
+    self.checker.refresh_pool.close()
+    self.checker.refresh_pool.join()
+    self.checker.refresh_pool = None
+
+  def test_answers_from_index(self):
+    self.assertEquals(self.checker.koscheck_internal('Bad Pilot'),
+                      'pilot: Bad Pilot')
+    self.assertEquals(self.checker.koscheck_internal('Good Pilot'),
+                      'alliance: Evil Alliance')
+    self.assertEquals(self.checker.koscheck_internal('Nice Pilot'),
+                      ChatKosLookup.NPC)
+    self.wait_for_refresh()
+    self.assertEquals(len(self.http.requests), 3)
+
+  def test_refresh_updates_index(self):
+    self.checker.koscheck_internal('Bad Pilot')
+    self.wait_for_refresh()
+    # The live answer is cached, and saved over the index.
+    self.assertEquals(self.checker.koscheck_internal('Bad Pilot'), None)
+    self.checker.save_index()
+    self.assertEquals(self.checker.index.find('Bad Pilot'), [])
+    self.assertEquals(len(self.checker.index.find('Good Pilot')), 1)
+
+  def test_index_verdict_not_cached(self):
+    self.checker.corp_history = lambda cid: []
+    self.assertEquals(self.checker.koscheck('Bad Pilot', 42),
+                      ('pilot: Bad Pilot', 42))
+    self.wait_for_refresh()
+    # The site's answer replaces the one from the index.
+    self.assertEquals(self.checker.koscheck('Bad Pilot', 42), (None, 42))
+
+  def test_unknown_goes_online(self):
+    self.assertEquals(self.checker.koscheck_internal('Other Pilot'), None)
+    self.assertEquals(len(self.http.requests), 1)
+    self.assertEquals(self.checker.refresh_pool, None)
+
+  def test_bad_index_ignored(self):
+    self.checker.index.close()
+    with open(self.checker.index.path, 'wb') as f:
+      f.write('not an index')
+    checker = ChatKosLookup.KosChecker(
+        cache_file=os.path.join(self.tmpdir, 'koscheck'), http=self.http)
+    self.assertEquals(len(checker.index), 0)
+    self.assertEquals(checker.koscheck_internal('Bad Pilot'), None)
+    checker.save_index()
+    self.assertEquals(len(checker.index), 0)
+    checker.index.close()
+
+  def test_failed_save_keeps_learned(self):
+    self.checker.koscheck_internal('Other Pilot')
+    def fail(units):
+      raise IOError('disk full')
+    self.checker.index.replace = fail
+    self.assertRaises(IOError, self.checker.save_index)
+    self.assertEquals(self.checker.learned.keys(), ['other pilot'])
+
+  def tearDown(self):
+    self.checker.index.close()
+    shutil.rmtree(self.tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,6 +7,7 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import urllib
 import urllib2
@@ -23,9 +24,16 @@ except ImportError:
   winsound = None
 
 import ChatKosLookup
+import KosCache
+import KosServer
+import KosStats
 
 
 MINUS_TAG = u'[\u2212]'  # Unicode MINUS SIGN
+# How many recent report lines are remembered to skip duplicates.
+RECENT_LINES = 100
+# How many lines of results are kept on screen.
+MAX_LABELS = 100
 KILLBOARD = "http://zkillboard.com/character/{}/"
 
 
@@ -50,28 +58,162 @@ def GetEveLogsDir():
   return None
 
 
-class wxHTML(wx.html.HtmlWindow):
-  def OnLinkClicked(self, link):
+class ResultList(wx.HtmlListBox):
+  """A virtual list with one row per block, newest first.
+
+  Only the rows on screen are laid out, and each block's HTML is built
+  once per change, so adding a result costs the same however much
+  history is kept.
+  """
+
+  def __init__(self, *args, **kwargs):
+    wx.HtmlListBox.__init__(self, *args, **kwargs)
+    self.blocks = []
+
+  def OnGetItem(self, n):
+    return self.blocks[n].Html()
+
+  def OnLinkClicked(self, n, link):
     webbrowser.open(link.GetHref())
 
+  def SetBlocks(self, blocks):
+    self.blocks = list(blocks)
+    self.SetItemCount(len(self.blocks))
+    self.RefreshAll()
+
+  def Prepend(self, block):
+    self.blocks.insert(0, block)
+    # Drop the oldest blocks once they no longer fit in MAX_LABELS lines.
+    lines = 0
+    for i, b in enumerate(self.blocks):
+      lines += len(b.Labels())
+      if lines > MAX_LABELS and i > 0:
+        del self.blocks[i:]
+        break
+    self.SetItemCount(len(self.blocks))
+    # Every row moved down one; only the visible ones get laid out again.
+    self.RefreshAll()
+
+  def RefreshBlock(self, block):
+    try:
+      self.RefreshRow(self.blocks.index(block))
+    except ValueError:
+      # Already scrolled off the end of the history.
+      pass
+
+
+class MessageBlock:
+  """Plain lines of text shown in the results window."""
+
+  def __init__(self, labels):
+    self.labels = labels
+
+  def Labels(self):
+    return self.labels
+
+  def Html(self):
+    return '<br>'.join(self.labels)
+
+
+class ResultBlock:
+  """The results for one log entry, filled in as its pilots resolve."""
+
+  def __init__(self, entry):
+    self.entry = entry
+    self.started = time.time()
+    self.kos = []
+    self.not_kos = []
+    self.error = []
+    self.labels = None
+    self.html = None
+
+  def AddPilot(self, pilot, reason, cid, exc_info):
+    self.labels = self.html = None
+    if exc_info:
+      self.error.append(pilot)
+    elif reason:
+      self.kos.append((pilot, reason, cid))
+      self.kos.sort(key=lambda (p, reason, cid): (reason, p))
+    else:
+      self.not_kos.append((pilot, cid))
+
+  def Html(self):
+    if self.html is None:
+      self.html = '<br>'.join(self.Labels())
+    return self.html
+
+  def Labels(self):
+    if self.labels is None:
+      self.labels = self.BuildLabels()
+    return self.labels
+
+  def BuildLabels(self):
+    kos, not_kos, error = self.kos, self.not_kos, self.error
+    new_labels = []
+    if self.entry.comment:
+      new_labels.append(self.entry.comment)
+    if kos or not_kos:
+      new_labels.append('KOS: {}  Not KOS: {}'.format(len(kos), len(not_kos)))
+    if kos:
+      new_labels.extend(
+          [(u'<font color="red">{minus} <a href="{killboard}">{pilot}</a> ({reason})</font>'.format(
+              minus=MINUS_TAG,
+              killboard=KILLBOARD.format(cid),
+              kospath="http://kos.cva-eve.org/?q=" + urllib.quote(p),
+              pilot=cgi.escape(p),
+              reason=cgi.escape(reason)))
+           for (p, reason, cid) in kos])
+    if not_kos:
+      if kos:
+        new_labels.append('')
+      new_labels.extend([('<font color="blue">[+] <a href="{killboard}">{pilot}</a></font>'.format(
+              pilot=p, killboard=KILLBOARD.format(cid)))
+              for (p, cid) in not_kos])
+    if error:
+      new_labels.append('Error: {}'.format(len(error)))
+      new_labels.extend(error)
+    if new_labels:
+      new_labels.append('<hr>')
+    return new_labels
+
 
 class MainFrame(wx.Frame):
   def __init__(self, *args, **kwargs):
     wx.Frame.__init__(self, *args, **kwargs)
     self.UpdateIcon()
     self.UpdateTitle()
-    self.checker = ChatKosLookup.KosChecker()
-    self.tailer = ChatKosLookup.DirectoryTailer(GetEveLogsDir())
-    self.labels = []
-    self.html = wxHTML(self, style=wx.html.HW_SCROLLBAR_NEVER)
+    self.stats = KosStats.Stats()
+    self.last_lookup = None
+    # KOS_SERVER=http://host:8765 shares a KosServer's cache with others.
+    server = os.environ.get('KOS_SERVER')
+    if server:
+      self.checker = KosServer.RemoteChecker(server, stats=self.stats)
+    else:
+      self.checker = ChatKosLookup.KosChecker(stats=self.stats)
+    # Checks everyone who speaks in the logs ahead of any report.
+    self.prefetcher = ChatKosLookup.Prefetcher(self.checker)
+    # Off unless chosen from the menu, as it looks up everyone in Local.
+    self.prefetch = False
+    self.tailer = ChatKosLookup.DirectoryTailer(GetEveLogsDir(),
+                                                stats=self.stats,
+                                                on_speaker=self.OnSpeaker)
+    # Lookups run on background threads and report back via wx.CallAfter.
+    self.engine = ChatKosLookup.LookupEngine(
+        self.checker,
+        on_pilot=lambda *args: wx.CallAfter(self.OnPilotResult, *args),
+        on_entry=lambda *args: wx.CallAfter(self.OnEntryResult, *args))
+    self.checking = {}
+    self.results = ResultList(self)
     self.status_bar = self.CreateStatusBar(1)
     self.status_bar.PushStatusText("Starting...")
     self.SetSize((300, 800))
     self.SetBackgroundColour('white')
-    self.recent_lines = []
+    self.recent_lines = KosCache.RecentSet(RECENT_LINES)
+    self.poll_pending = False
     self.CreateMenu()
-    self.UpdateLabels()
+    self.UpdateStatus()
     self.KosCheckerPoll()
+    self.StartLogWatcher()
     self.CheckArgs()
     self.Show()
 
@@ -80,9 +222,14 @@ class MainFrame(wx.Frame):
     help_menu = wx.Menu()
     reset_id = wx.NewId()
     update_id = wx.NewId()
+    timings_id = wx.NewId()
+    prefetch_id = wx.NewId()
+    help_menu.Append(timings_id, "Timings")
     help_menu.Append(wx.ID_ABOUT, "About")
     file_menu.Append(reset_id, "Reset")
     file_menu.Append(update_id, "Update")
+    file_menu.AppendCheckItem(prefetch_id, "Prefetch speakers").Check(
+        self.prefetch)
     file_menu.Append(wx.ID_EXIT, "Exit")
     menu_bar = wx.MenuBar()
     menu_bar.Append(file_menu, "File")
@@ -90,8 +237,11 @@ class MainFrame(wx.Frame):
     self.SetMenuBar(menu_bar)
     self.Bind(wx.EVT_MENU, self.OnReset, id=reset_id)
     self.Bind(wx.EVT_MENU, self.OnUpdate, id=update_id)
+    self.Bind(wx.EVT_MENU, self.OnTimings, id=timings_id)
+    self.Bind(wx.EVT_MENU, self.OnPrefetch, id=prefetch_id)
     self.Bind(wx.EVT_MENU, self.OnExit, id=wx.ID_EXIT)
     self.Bind(wx.EVT_MENU, self.OnAbout, id=wx.ID_ABOUT)
+    self.Bind(wx.EVT_CLOSE, self.OnClose)
 
   def UpdateIcon(self):
     """
@@ -115,64 +265,67 @@ class MainFrame(wx.Frame):
     if os.path.exists(icon_path):
       self.SetIcon(wx.Icon(icon_path, wx.BITMAP_TYPE_ICO))
 
+  def StartLogWatcher(self):
+    """Wakes KosCheckerPoll whenever a log is written, where supported.
+
+    Without an event-driven watcher, KosCheckerPoll reschedules itself
+    every second instead.
+    """
+    if not self.tailer.event_driven:
+      return
+    thread = threading.Thread(target=self.WatchLogs)
+    thread.daemon = True
+    thread.start()
+
+  def WatchLogs(self):
+    while True:
+      # Re-read self.tailer each time around, as OnReset replaces it.
+      if self.tailer.wait(1.0) and not self.poll_pending:
+        self.poll_pending = True
+        wx.CallAfter(self.KosCheckerPoll)
+
   def KosCheckerPoll(self):
-    play_sound = False
-    action = False
-    self.status_bar.PushStatusText("Checking for KOS pilots")
+    self.poll_pending = False
     for entry in iter(self.tailer.poll, None):
-      action = True
-      if entry.linekey in self.recent_lines:
+      if not self.recent_lines.add(entry.linekey):
         continue
-      self.recent_lines.append(entry.linekey)
-
-      self.status_bar.PushStatusText("KOS Checking {} pilots".format(
-        len(entry.pilots)))
-      kos, not_kos, error = self.checker.koscheck_logentry(entry.pilots)
-      self.status_bar.PopStatusText()
-
-      for pilot, reason, cid in kos:
-        if pilot.startswith('CCP '):
-          self.PlayKosAlertSound()
-          self.PlayKosAlertSound()
-          self.PlayKosAlertSound()
-
-      new_labels = []
-      if entry.comment:
-        new_labels.append(entry.comment)
-      if kos or not_kos:
-        new_labels.append('KOS: {}  Not KOS: {}'.format(len(kos), len(not_kos)))
-      if kos:
-        play_sound = True
-        new_labels.extend(
-            [(u'<font color="red">{minus} <a href="{killboard}">{pilot}</a> ({reason})</font>'.format(
-                minus=MINUS_TAG,
-                killboard=KILLBOARD.format(cid),
-                kospath="http://kos.cva-eve.org/?q=" + urllib.quote(p),
-                pilot=cgi.escape(p),
-                reason=cgi.escape(reason)))
-             for (p, reason, cid) in kos])
-      if not_kos:
-        if kos:
-          new_labels.append('')
-        new_labels.extend([('<font color="blue">[+] <a href="{killboard}">{pilot}</a></font>'.format(
-                pilot=p, killboard=KILLBOARD.format(cid)))
-                for (p, cid) in not_kos])
-      if error:
-        new_labels.append('Error: {}'.format(len(error)))
-        new_labels.extend(error)
-      if new_labels:
-        new_labels.append('<hr>')
-      self.labels = new_labels + self.labels
-      self.labels = self.labels[:100]
-    self.status_bar.PopStatusText()
+      block = ResultBlock(entry)
+      self.checking[entry.linekey] = block
+      self.results.Prepend(block)
+      self.engine.submit(entry)
+      self.UpdateStatus()
+
+    if not self.tailer.event_driven:
+      wx.FutureCall(1000, self.KosCheckerPoll)
+
+  def OnPilotResult(self, entry, pilot, reason, cid, exc_info):
+    block = self.checking.get(entry.linekey)
+    if block is None:
+      return
+    block.AddPilot(pilot, reason, cid, exc_info)
+    if reason:
+      if pilot.startswith('CCP '):
+        self.PlayKosAlertSound()
+        self.PlayKosAlertSound()
+        self.PlayKosAlertSound()
+      if len(block.kos) == 1:
+        # The first hostile of an entry sounds the alarm straight away.
+        self.PlayKosAlertSound()
+    self.results.RefreshBlock(block)
+
+  def OnEntryResult(self, entry, kos, not_kos, error):
+    block = self.checking.pop(entry.linekey, None)
+    if block is None:
+      return
+    self.last_lookup = time.time() - block.started
+    self.UpdateStatus()
 
-    if play_sound:
-      self.PlayKosAlertSound()
-    if action:
-      self.recent_lines = self.recent_lines[-100:]
-      self.UpdateLabels()
+  def OnSpeaker(self, pilot):
+    if self.prefetch:
+      self.prefetcher.add(pilot)
 
-    wx.FutureCall(1000, self.KosCheckerPoll)
+  def OnPrefetch(self, event):
+    self.prefetch = event.IsChecked()
 
   def PlayKosAlertSound(self):
     global winsound
@@ -183,7 +336,7 @@ class MainFrame(wx.Frame):
         # such as when there's no SystemQuestion sound, reported by some users.
         winsound = False
 
-  def UpdateLabels(self):
+  def UpdateStatus(self):
     self.status_bar.PopStatusText()
     last_update = self.tailer.last_update()
     if last_update:
@@ -192,31 +345,58 @@ class MainFrame(wx.Frame):
             ).strftime("%Y-%m-%d %H:%M:%S"))
     else:
       status = "No logs found"
+    if self.checking:
+      status = "KOS Checking {} entries".format(len(self.checking))
+    elif self.last_lookup is not None:
+      status += "  (lookup {:.0f} ms)".format(1000 * self.last_lookup)
     self.status_bar.PushStatusText(status)
-    self.html.SetPage('<br>'.join(self.labels))
 
   def UpdateTitle(self):
     self.SetLabel("Kill On Sight")
 
   def OnReset(self, event):
     logs_dir = GetEveLogsDir()
-    self.tailer = ChatKosLookup.DirectoryTailer(logs_dir)
+    old_tailer = self.tailer
+    self.tailer = ChatKosLookup.DirectoryTailer(logs_dir, stats=self.stats,
+                                                on_speaker=self.OnSpeaker)
+    old_tailer.close()
     last_update = self.tailer.last_update()
-    self.labels = []
-    self.labels.append('Checking logs in {}'.format(logs_dir))
+    labels = []
+    labels.append('Checking logs in {}'.format(logs_dir))
     if last_update:
       minutes_ago = int((time.time() - last_update) / 60)
       last_update = datetime.datetime.fromtimestamp(last_update
             ).strftime("%Y-%m-%d %H:%M:%S")
-      self.labels.append(
+      labels.append(
           'Reset Complete: reading {} log files'.format(
               len(self.tailer.watchers)))
-      self.labels.append('last update: {}, {} minutes ago'.format(
+      labels.append('last update: {}, {} minutes ago'.format(
               last_update, minutes_ago))
     else:
-      self.labels.append(
+      labels.append(
           'Reset Complete, no log files found')
-    self.UpdateLabels()
+    self.results.SetBlocks([MessageBlock(labels)])
+    self.checking = {}
+    self.UpdateStatus()
+
+  def OnTimings(self, event):
+    cache = self.checker.cache.stats()
+    text = '{}\n\nmemory cache: {} entries, {} hits, {} misses, {} evictions'.format(
+        self.stats.format(), cache['size'], cache['hits'], cache['misses'],
+        cache['evictions'])
+    if self.checker.http.scheduler:
+      scheduler = self.checker.http.scheduler.snapshot()
+      text += '\nqueued requests: {}  backoff: {:.1f}s'.format(
+          ', '.join('{} {}'.format(n, name)
+                    for (name, n) in sorted(scheduler['queued'].items())),
+          scheduler['backoff'])
+    else:
+      text += '\nlookups by server: {}'.format(self.checker.server_url)
+    text += '\nlog files: {watched} watched, {open} open'.format(
+        **self.tailer.counts())
+    dlg = wx.MessageDialog(self, text, 'Timings', wx.OK | wx.ICON_INFORMATION)
+    dlg.ShowModal()
+    dlg.Destroy()
 
   def OnAbout(self, event):
     dlg = wx.MessageDialog(
@@ -231,6 +411,14 @@ class MainFrame(wx.Frame):
   def OnExit(self, event):
     self.Close()
 
+  def OnClose(self, event):
+    # Keep what was looked up this session for offline use next time.
+    try:
+      self.checker.save_index()
+    except (IOError, OSError):
+      pass
+    event.Skip()
+
   def CheckArgs(self):
     if not zipfile.is_zipfile(sys.executable):
       return
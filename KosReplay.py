@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""Replays whole chat log directories and reports every pilot called out.
+
+Usage: KosReplay.py [-p 'Fleet_*.txt'] [-p 'Intel_*.txt'] [-j N] [-o report.csv]
+                    ~/EVE/logs/Chatlogs [more directories...]
+
+Log files are parsed in parallel across a process pool. The pilots
+reported in them are then de-duplicated and checked with the batched,
+cached KosChecker path.
+"""
+
+import argparse
+import csv
+import fnmatch
+import multiprocessing
+import os
+import sys
+import time
+
+import ChatKosLookup
+import KosHttp
+
+DEFAULT_PATTERNS = ('Fleet_*.txt',)
+# Pilots handed to the checker at a time.
+CHECK_BATCH_SIZE = ChatKosLookup.ID_BATCH_SIZE
+
+
+def find_logs(directories, patterns):
+  """Lists the files in directories whose names match any of patterns."""
+  logs = []
+  for directory in directories:
+    for name in sorted(os.listdir(directory)):
+      if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+        logs.append(os.path.join(directory, name))
+  return logs
+
+
+def scan_log(filename):
+  """Parses a whole log file.
+
+  Runs in a worker process, so it only returns plain data.
+
+  @returns: (filename, entries, error) where entries is a list of
+      (pilots, comment, linekey, date) tuples.
+  """
+  try:
+    tailer = ChatKosLookup.FileTailer(filename, from_start=True)
+  except IOError as e:
+    return filename, [], str(e)
+  try:
+    entries = [tuple(entry) + (tailer.last_date,)
+               for entry in iter(tailer.poll, None)]
+  except UnicodeError as e:
+    return filename, [], str(e)
+  tailer.close()
+  return filename, entries, None
+
+
+class Sighting:
+  """Everything the logs say about one reported pilot."""
+
+  def __init__(self, name):
+    self.name = name
+    self.reports = 0
+    self.files = set()
+    self.first_comment = None
+    self.reason = None
+    self.cid = None
+    self.error = None
+
+
+def collect(scans):
+  """Merges per-file scans into one Sighting per pilot.
+
+  The same report relayed into several channels is only counted once.
+
+  @returns: (sightings by lower-cased name, list of (filename, error)).
+  """
+  sightings = {}
+  seen_lines = set()
+  errors = []
+  for filename, entries, error in scans:
+    if error:
+      errors.append((filename, error))
+    for pilots, comment, linekey, date in entries:
+      # linekey has no date, and the same report on another day is new.
+      duplicate = (date, linekey) in seen_lines
+      seen_lines.add((date, linekey))
+      for pilot in pilots:
+        pilot = pilot.strip(' .')
+        if not pilot or pilot.isspace():
+          continue
+        sighting = sightings.get(pilot.lower())
+        if sighting is None:
+          sighting = sightings[pilot.lower()] = Sighting(pilot)
+          sighting.first_comment = comment
+        sighting.files.add(os.path.basename(filename))
+        if not duplicate:
+          sighting.reports += 1
+  return sightings, errors
+
+
+def check_sightings(checker, sightings):
+  """Fills in each Sighting's verdict, checking pilots in batches."""
+  sightings = sorted(sightings, key=lambda s: s.name)
+  for start in range(0, len(sightings), CHECK_BATCH_SIZE):
+    batch = sightings[start:start + CHECK_BATCH_SIZE]
+    with KosHttp.priority(KosHttp.BULK):
+      results = checker.koscheck_pilots([s.name for s in batch])
+    for sighting, (result, exc_info) in zip(batch, results):
+      if exc_info:
+        sighting.error = unicode(exc_info[1]) or exc_info[0].__name__
+      else:
+        sighting.reason, sighting.cid = result
+
+
+def write_report(sightings, output):
+  writer = csv.writer(output)
+  writer.writerow(['pilot', 'verdict', 'reason', 'character_id', 'reports',
+                   'first_report', 'files'])
+  def order(s):
+    return (s.error is not None, s.reason is None, s.name.lower())
+  for s in sorted(sightings, key=order):
+    if s.error:
+      verdict = 'error'
+    else:
+      verdict = ChatKosLookup.verdict_class(s.reason)
+    row = [s.name, verdict, s.reason or s.error or '', s.cid or '',
+           s.reports, s.first_comment, ' '.join(sorted(s.files))]
+    writer.writerow([unicode(v).encode('utf-8') for v in row])
+
+
+def replay(directories, patterns=DEFAULT_PATTERNS, processes=None,
+           checker=None, output=sys.stdout):
+  logs = find_logs(directories, patterns)
+  start = time.time()
+  pool = multiprocessing.Pool(processes)
+  try:
+    scans = list(pool.imap_unordered(scan_log, logs, chunksize=8))
+  finally:
+    pool.close()
+    pool.join()
+  sightings, errors = collect(scans)
+  parsed = time.time()
+  print >>sys.stderr, 'Parsed %d logs in %.1fs: %d pilots reported' % (
+      len(logs), parsed - start, len(sightings))
+  for filename, error in errors:
+    print >>sys.stderr, 'Skipped %s: %s' % (filename, error)
+
+  checker = checker or ChatKosLookup.KosChecker()
+  check_sightings(checker, sightings.values())
+  print >>sys.stderr, 'Checked %d pilots in %.1fs' % (
+      len(sightings), time.time() - parsed)
+  write_report(sightings.values(), output)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Checks every pilot reported in old chat logs.')
+  parser.add_argument('directories', nargs='+')
+  parser.add_argument('-p', '--pattern', action='append', dest='patterns',
+                      help='log file name pattern (default: Fleet_*.txt)')
+  parser.add_argument('-j', '--processes', type=int, default=None,
+                      help='parser processes (default: one per core)')
+  parser.add_argument('-o', '--output', help='report file (default: stdout)')
+  args = parser.parse_args()
+
+  output = open(args.output, 'wb') if args.output else sys.stdout
+  try:
+    replay(args.directories, args.patterns or DEFAULT_PATTERNS,
+           args.processes, output=output)
+  finally:
+    if args.output:
+      output.close()
+
+
+if __name__ == '__main__':
+  multiprocessing.freeze_support()
+  main()
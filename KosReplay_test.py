@@ -0,0 +1,113 @@
+import csv
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('evelink-api')
+
+import KosReplay
+from ChatKosLookup_test import SlowChecker
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'KosReplay_test.txt')
+
+
+class TestKosReplay(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    # The same reports relayed into two channels, and a log not replayed.
+    for name in ('Fleet_20120729_002300.txt', 'Fleet_20120729_002301.txt',
+                 'Local_20120729_002300.txt'):
+      shutil.copy(FIXTURE, os.path.join(self.tmpdir, name))
+    # Not the GUI's cache.
+    self.cache_file = os.path.join(self.tmpdir, 'koscheck')
+
+  def test_find_logs(self):
+    logs = KosReplay.find_logs([self.tmpdir], KosReplay.DEFAULT_PATTERNS)
+    self.assertEquals([os.path.basename(log) for log in logs],
+                      ['Fleet_20120729_002300.txt',
+                       'Fleet_20120729_002301.txt'])
+    self.assertEquals(len(KosReplay.find_logs([self.tmpdir], ('*.txt',))), 3)
+
+  def test_scan_log(self):
+    filename, entries, error = KosReplay.scan_log(FIXTURE)
+    self.assertEquals(error, None)
+    self.assertEquals([pilots for (pilots, comment, linekey, date)
+                       in entries],
+                      [('Bad Pilot', 'Good Pilot'), ('bad pilot',),
+                       ('Broken Pilot',)])
+    self.assertEquals(entries[0][1], '[00:23:56] Foo Bar > gate')
+    self.assertEquals(entries[0][3], '2012.07.29')
+
+  def test_scan_missing_log(self):
+    filename, entries, error = KosReplay.scan_log(
+        os.path.join(self.tmpdir, 'missing.txt'))
+    self.assertEquals(entries, [])
+    self.assertTrue(error)
+
+  def test_collect(self):
+    logs = KosReplay.find_logs([self.tmpdir], KosReplay.DEFAULT_PATTERNS)
+    scans = [KosReplay.scan_log(log) for log in logs]
+    scans.append(('broken.txt', [], 'unreadable'))
+    sightings, errors = KosReplay.collect(scans)
+    self.assertEquals(sorted(sightings),
+                      ['bad pilot', 'broken pilot', 'good pilot'])
+    bad = sightings['bad pilot']
+    # Relayed copies count once, but both files are listed.
+    self.assertEquals(bad.reports, 2)
+    self.assertEquals(bad.name, 'Bad Pilot')
+    self.assertEquals(bad.first_comment, '[00:23:56] Foo Bar > gate')
+    self.assertEquals(sorted(bad.files), ['Fleet_20120729_002300.txt',
+                                          'Fleet_20120729_002301.txt'])
+    self.assertEquals(errors, [('broken.txt', 'unreadable')])
+
+  def test_collect_other_days(self):
+    # The same reports, at the same times, a week later.
+    with open(FIXTURE, 'rb') as f:
+      text = f.read().decode('utf-16').replace(u'2012.07.29', u'2012.08.05')
+    with open(os.path.join(self.tmpdir, 'Fleet_20120805_002300.txt'),
+              'wb') as f:
+      f.write(text.encode('utf-16'))
+    logs = KosReplay.find_logs([self.tmpdir], KosReplay.DEFAULT_PATTERNS)
+    sightings, errors = KosReplay.collect(
+        [KosReplay.scan_log(log) for log in logs])
+    self.assertEquals(sightings['bad pilot'].reports, 4)
+    self.assertEquals(sightings['good pilot'].reports, 2)
+
+  def test_report(self):
+    sightings, errors = KosReplay.collect([KosReplay.scan_log(FIXTURE)])
+    KosReplay.check_sightings(SlowChecker(cache_file=self.cache_file),
+                              sightings.values())
+    output = io.BytesIO()
+    KosReplay.write_report(sightings.values(), output)
+    rows = list(csv.reader(io.BytesIO(output.getvalue())))
+    self.assertEquals(rows[0][:3], ['pilot', 'verdict', 'reason'])
+    # KOS first, then not KOS, then errors.
+    self.assertEquals([row[:5] for row in rows[1:]], [
+        ['Bad Pilot', 'kos', 'pilot: Bad Pilot', '9', '2'],
+        ['Good Pilot', 'notkos', '', '10', '1'],
+        ['Broken Pilot', 'error', 'Broken Pilot', '', '1'],
+    ])
+
+  def test_unicode_error(self):
+    sightings, errors = KosReplay.collect([KosReplay.scan_log(FIXTURE)])
+    checker = SlowChecker(cache_file=self.cache_file)
+    def fail(player, cid=None):
+      raise ValueError(u'no such pilot: J\xf6rg')
+    checker.koscheck = fail
+    KosReplay.check_sightings(checker, sightings.values())
+    output = io.BytesIO()
+    KosReplay.write_report(sightings.values(), output)
+    rows = list(csv.reader(io.BytesIO(output.getvalue())))
+    self.assertEquals(rows[1][1:3],
+                      ['error', u'no such pilot: J\xf6rg'.encode('utf-8')])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""A headless KOS lookup server, so a whole corp can share one cache.
+
+Usage: KosServer.py [--host 127.0.0.1] [--port 8765] [--stats]
+
+Endpoints, all answering JSON:
+
+  GET  /check?pilot=Name      one result
+  POST /batch {"pilots": [...]}  {"results": [result, ...]} in the same order
+  GET  /stats                 lookup timings, cache and scheduler state
+
+where a result is {"pilot", "kos", "reason", "class", "character_id",
+"error"}. Every client shares the server's KosChecker, and so its caches
+and request scheduler. Lookups are scheduled at the priority named in an
+X-Kos-Priority header (see KosHttp.PRIORITY_NAMES), interactive if none.
+Failures answer {"error": ...} with a 4xx or 5xx status.
+
+KosLookupExe uses a server when the KOS_SERVER environment variable
+holds its URL, and ChatKosLookup.py when given --server URL.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import sys
+import traceback
+import urlparse
+
+import ChatKosLookup
+import KosCache
+import KosHttp
+import KosStats
+
+DEFAULT_PORT = 8765
+PRIORITY_HEADER = 'X-Kos-Priority'
+# Pilots accepted in one batch request.
+MAX_BATCH = 1000
+
+
+class RemoteError(Exception):
+  """A lookup that failed on the server."""
+
+
+def result_json(pilot, result, exc_info):
+  """Turns a koscheck_pilots result into a JSON-able dict."""
+  if exc_info:
+    return {'pilot': pilot, 'kos': None, 'reason': None, 'class': None,
+            'character_id': None, 'error': unicode(exc_info[1]) or
+            exc_info[0].__name__}
+  reason, cid = result
+  return {'pilot': pilot, 'kos': bool(reason), 'reason': reason,
+          'class': ChatKosLookup.verdict_class(reason), 'character_id': cid,
+          'error': None}
+
+
+class BadRequest(Exception):
+  pass
+
+
+class KosHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one go; see KosBenchmark.StandInHandler.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    params = urlparse.parse_qs(url.query)
+    if url.path == '/check':
+      self.handle_json(self.check, params.get('pilot', [''])[0])
+    elif url.path == '/stats':
+      self.handle_json(self.server.status)
+    else:
+      self.respond(404, {'error': 'no such endpoint: %s' % url.path})
+
+  def do_POST(self):
+    url = urlparse.urlparse(self.path)
+    length = int(self.headers.getheader('content-length') or 0)
+    body = self.rfile.read(length)
+    if url.path == '/batch':
+      self.handle_json(self.batch, body)
+    else:
+      self.respond(404, {'error': 'no such endpoint: %s' % url.path})
+
+  def handle_json(self, func, *args):
+    try:
+      with KosHttp.priority(self.priority()):
+        value = func(*args)
+    except BadRequest as e:
+      self.respond(400, {'error': str(e)})
+    except Exception as e:
+      traceback.print_exc()
+      self.respond(500, {'error': unicode(e) or type(e).__name__})
+    else:
+      self.respond(200, value)
+
+  def priority(self):
+    """The client's priority for this request; see KosHttp."""
+    name = self.headers.getheader(PRIORITY_HEADER, '').strip().lower()
+    if name in KosHttp.PRIORITY_NAMES:
+      return KosHttp.PRIORITY_NAMES.index(name)
+    return KosHttp.INTERACTIVE
+
+  def check(self, pilot):
+    pilot = pilot.decode('utf-8').strip(' .')
+    if not pilot:
+      raise BadRequest('pilot is required')
+    return self.server.lookup([pilot])[0]
+
+  def batch(self, body):
+    try:
+      pilots = json.loads(body)['pilots']
+    except (ValueError, KeyError, TypeError):
+      raise BadRequest('expected {"pilots": [...]}')
+    if (not isinstance(pilots, list) or
+        not all(isinstance(p, basestring) for p in pilots)):
+      raise BadRequest('pilots must be a list of names')
+    if len(pilots) > MAX_BATCH:
+      raise BadRequest('at most %d pilots per batch' % MAX_BATCH)
+    return {'results': self.server.lookup(pilots)}
+
+  def respond(self, status, value):
+    body = json.dumps(value)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class KosServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Answers lookups from many clients with one shared KosChecker."""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, checker, host='127.0.0.1', port=DEFAULT_PORT,
+               verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), KosHandler)
+    self.checker = checker
+    self.verbose = verbose
+    self.url = 'http://%s:%d' % self.server_address
+
+  def lookup(self, pilots):
+    """Checks pilots, answering in the same order as asked."""
+    people = [pilot.strip(' .') for pilot in pilots]
+    results = iter(self.checker.koscheck_pilots([p for p in people if p]))
+    answers = []
+    for pilot in people:
+      if pilot:
+        answers.append(result_json(pilot, *next(results)))
+      else:
+        answers.append(result_json(pilot, None, (BadRequest,
+                                                 BadRequest('no name'), None)))
+    return answers
+
+  def status(self):
+    scheduler = self.checker.http.scheduler
+    return {
+        'stats': self.checker.stats.snapshot(),
+        'cache': self.checker.cache.stats(),
+        'scheduler': scheduler.snapshot() if scheduler else None,
+    }
+
+
+class RemoteChecker(ChatKosLookup.KosChecker):
+  """A KosChecker that asks a KosServer rather than the KOS site.
+
+  Only the pilot checks used by the GUI and command line go to the
+  server; IDs are resolved there too. Caching is left to the server, so
+  none of KosChecker's local caches, index or pools are set up.
+  """
+
+  def __init__(self, server_url, stats=KosStats.DISABLED, http=None):
+    self.stats = stats
+    # The server paces the real lookups, so requests to it needn't wait.
+    self.http = http or KosHttp.HttpPool(stats=stats)
+    # Always empty; only here for the GUI's cache statistics.
+    self.cache = KosCache.MemoryCache(0)
+    self.server_url = server_url.rstrip('/')
+
+  def character_ids_from_names(self, names):
+    return dict((name, None) for name in names)
+
+  def save_index(self):
+    """Nothing to save; the server keeps the index."""
+
+  def koscheck(self, player, cid=None):
+    [(result, exc_info)] = self.koscheck_pilots([player])
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return result
+
+  def koscheck_pilots(self, people):
+    if not people:
+      return []
+    # So the server schedules e.g. prefetches behind everyone's reports.
+    headers = {PRIORITY_HEADER:
+               KosHttp.PRIORITY_NAMES[KosHttp.current_priority()]}
+    with self.stats.timer('remote'):
+      reply = json.loads(self.http.request(
+          self.server_url + '/batch', json.dumps({'pilots': people}),
+          headers))
+    results = []
+    for value in reply['results']:
+      if value['error']:
+        try:
+          raise RemoteError(value['error'])
+        except RemoteError:
+          results.append((None, sys.exc_info()))
+      else:
+        results.append(((value['reason'], value['character_id']), None))
+    return results
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Serves KOS lookups to KosLookup clients over HTTP.')
+  parser.add_argument('--host', default='127.0.0.1',
+                      help='address to listen on; 0.0.0.0 to share on a LAN')
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+  parser.add_argument('--cache', help='cache file (default: in temp dir)')
+  parser.add_argument('--stats', action='store_true',
+                      help='time lookups, for /stats')
+  parser.add_argument('-v', '--verbose', action='store_true',
+                      help='log every request')
+  args = parser.parse_args()
+
+  stats = KosStats.Stats(enabled=args.stats)
+  checker = ChatKosLookup.KosChecker(stats=stats, cache_file=args.cache)
+  server = KosServer(checker, args.host, args.port, args.verbose)
+  print >>sys.stderr, 'Serving KOS lookups on %s' % server.url
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    checker.save_index()
+
+
+if __name__ == '__main__':
+  main()
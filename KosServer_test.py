@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib2
+
+sys.path.append('evelink-api')
+
+import ChatKosLookup
+import KosHttp
+import KosServer
+from ChatKosLookup_test import SlowChecker
+
+
+class TestKosServer(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.checker = SlowChecker(
+        max_workers=4, cache_file=os.path.join(self.tmpdir, 'koscheck'))
+    self.server = KosServer.KosServer(self.checker, port=0)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.http = KosHttp.HttpPool()
+    self.remote = KosServer.RemoteChecker(self.server.url, http=self.http)
+
+  def get(self, path):
+    return json.loads(self.http.request(self.server.url + path))
+
+  def test_single(self):
+    self.assertEquals(self.get('/check?pilot=Bad+Pilot'), {
+        'pilot': 'Bad Pilot', 'kos': True, 'reason': 'pilot: Bad Pilot',
+        'class': ChatKosLookup.KOS, 'character_id': 9, 'error': None})
+    self.assertEquals(self.get('/check?pilot=Good%20Pilot')['class'],
+                      ChatKosLookup.NOTKOS)
+
+  def test_batch(self):
+    results = json.loads(self.http.request(
+        self.server.url + '/batch',
+        json.dumps({'pilots': ['Good Pilot', 'Broken Pilot', ' ',
+                               'Worse Pilot']})))['results']
+    self.assertEquals([r['pilot'] for r in results],
+                      ['Good Pilot', 'Broken Pilot', '', 'Worse Pilot'])
+    self.assertEquals(results[0]['kos'], False)
+    self.assertEquals(results[1]['error'], 'Broken Pilot')
+    self.assertEquals(results[2]['error'], 'no name')
+    self.assertEquals(results[3]['reason'], 'corp: Evil Corp')
+    self.assertEquals(self.checker.batches, 1)
+
+  def test_bad_requests(self):
+    for path, data in (('/check', None), ('/batch', 'nonsense'),
+                       ('/batch', json.dumps({'pilots': 'Bad Pilot'})),
+                       ('/missing', None)):
+      try:
+        self.http.request(self.server.url + path, data)
+        self.fail(path)
+      except urllib2.HTTPError as e:
+        self.assertTrue(e.code in (400, 404))
+        self.assertTrue(json.loads(e.read())['error'])
+
+  def test_stats(self):
+    status = self.get('/stats')
+    self.assertTrue('cache' in status)
+    self.assertEquals(sum(status['scheduler']['queued'].values()), 0)
+
+  def test_remote_checker(self):
+    self.assertEquals(self.remote.koscheck('Bad Pilot'),
+                      ('pilot: Bad Pilot', 9))
+    self.assertEquals(self.remote.koscheck_logentry(
+        ('Good Pilot', 'Worse Pilot', 'Bad Pilot.')),
+        ([('Worse Pilot', 'corp: Evil Corp', 11),
+          ('Bad Pilot', 'pilot: Bad Pilot', 9)],
+         [('Good Pilot', 10)],
+         []))
+    self.assertRaises(KosServer.RemoteError, self.remote.koscheck,
+                      'Broken Pilot')
+
+  def test_remote_keeps_no_local_cache(self):
+    tmpdir = os.path.join(self.tmpdir, 'client')
+    os.mkdir(tmpdir)
+    old_tempdir, tempfile.tempdir = tempfile.tempdir, tmpdir
+    try:
+      remote = KosServer.RemoteChecker(self.server.url, http=self.http)
+    finally:
+      tempfile.tempdir = old_tempdir
+    self.assertEquals(remote.koscheck('Bad Pilot'), ('pilot: Bad Pilot', 9))
+    remote.save_index()
+    self.assertEquals(os.listdir(tmpdir), [])
+    self.assertEquals(remote.cache.stats()['size'], 0)
+
+  def test_concurrent_clients(self):
+    results = []
+    def client(name):
+      remote = KosServer.RemoteChecker(self.server.url)
+      results.append(remote.koscheck(name))
+      remote.http.close()
+    threads = [threading.Thread(target=client, args=('Bad Pilot',))
+               for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(5)
+    self.assertEquals(results, [('pilot: Bad Pilot', 9)] * 8)
+
+  def test_server_error(self):
+    def fail(people):
+      raise IOError('EVE API unreachable')
+    self.checker.koscheck_pilots = fail
+    try:
+      self.remote.koscheck('Bad Pilot')
+      self.fail()
+    except urllib2.HTTPError as e:
+      self.assertEquals(e.code, 500)
+      self.assertEquals(json.loads(e.read())['error'], 'EVE API unreachable')
+
+  def test_ids_unavailable(self):
+    def fail(names):
+      raise IOError('EVE API unreachable')
+    self.checker.character_ids_from_names = fail
+    self.assertEquals(self.remote.koscheck('Bad Pilot'),
+                      ('pilot: Bad Pilot', None))
+
+  def test_priority_forwarded(self):
+    levels = []
+    koscheck = self.checker.koscheck
+    def record(player, cid=None):
+      levels.append(KosHttp.current_priority())
+      return koscheck(player, cid)
+    self.checker.koscheck = record
+    with KosHttp.priority(KosHttp.BACKGROUND):
+      self.remote.koscheck_pilots(['Bad Pilot', 'Good Pilot'])
+    self.remote.koscheck('Bad Pilot')
+    self.assertEquals(levels,
+                      [KosHttp.BACKGROUND, KosHttp.BACKGROUND,
+                       KosHttp.INTERACTIVE])
+
+  def test_unicode_error(self):
+    def fail(player, cid=None):
+      raise ValueError(u'no such pilot: J\xf6rg')
+    self.checker.koscheck = fail
+    try:
+      self.remote.koscheck('Bad Pilot')
+      self.fail()
+    except KosServer.RemoteError as e:
+      self.assertEquals(e.args[0], u'no such pilot: J\xf6rg')
+
+  def tearDown(self):
+    self.http.close()
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,144 @@
+"""Timing counters for the stages of a KOS lookup.
+
+Each stage (a cache lookup, an HTTP call, tailing the logs...) keeps a
+count, total and maximum time, and a coarse histogram of durations:
+
+  stats = KosStats.Stats()
+  with stats.timer('kos_http'):
+    ...
+  print stats.format()
+
+A disabled Stats hands out a shared do-nothing timer, so instrumented
+code costs next to nothing when nobody is looking.
+"""
+
+import bisect
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0)
+
+
+class StageStats:
+  """Durations recorded for a single stage."""
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    # One extra bucket for anything slower than the last bound.
+    self.buckets = [0] * (len(BUCKETS) + 1)
+
+  def record(self, seconds):
+    self.count += 1
+    self.total += seconds
+    self.max = max(self.max, seconds)
+    self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+  def percentile(self, fraction):
+    """Estimates a percentile as the upper bound of its bucket, at most max."""
+    wanted = fraction * self.count
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= wanted:
+        return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+    return 0.0
+
+  def as_dict(self):
+    return {
+        'count': self.count,
+        'total': self.total,
+        'mean': self.total / self.count if self.count else 0.0,
+        'max': self.max,
+        'p50': self.percentile(0.5),
+        'p99': self.percentile(0.99),
+        'buckets': list(self.buckets),
+    }
+
+
+class _Timer:
+  def __init__(self, stats, stage):
+    self.stats = stats
+    self.stage = stage
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stats.record(self.stage, time.time() - self.start)
+
+
+class _NullTimer:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+NULL_TIMER = _NullTimer()
+
+
+class Stats:
+  """Thread-safe per-stage timings and plain event counters."""
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.lock = threading.Lock()
+    self.stages = {}
+    self.counters = {}
+
+  def timer(self, stage):
+    """Returns a context manager that records how long its body takes."""
+    if not self.enabled:
+      return NULL_TIMER
+    return _Timer(self, stage)
+
+  def record(self, stage, seconds):
+    if not self.enabled:
+      return
+    with self.lock:
+      stats = self.stages.get(stage)
+      if stats is None:
+        stats = self.stages[stage] = StageStats()
+      stats.record(seconds)
+
+  def increment(self, counter, amount=1):
+    if not self.enabled:
+      return
+    with self.lock:
+      self.counters[counter] = self.counters.get(counter, 0) + amount
+
+  def reset(self):
+    with self.lock:
+      self.stages = {}
+      self.counters = {}
+
+  def snapshot(self):
+    """Returns {'stages': {stage: {...}}, 'counters': {name: n}}."""
+    with self.lock:
+      return {
+          'stages': dict((stage, stats.as_dict())
+                         for stage, stats in self.stages.iteritems()),
+          'counters': dict(self.counters),
+      }
+
+  def format(self):
+    """Renders the snapshot as a small text table."""
+    snapshot = self.snapshot()
+    lines = ['%-20s %7s %9s %9s %9s %9s' % (
+        'stage', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+    for stage, s in sorted(snapshot['stages'].iteritems()):
+      lines.append('%-20s %7d %9.1f %9.1f %9.1f %9.1f' % (
+          stage, s['count'], 1000 * s['mean'], 1000 * s['p50'],
+          1000 * s['p99'], 1000 * s['max']))
+    for counter, n in sorted(snapshot['counters'].iteritems()):
+      lines.append('%-20s %7d' % (counter, n))
+    return '\n'.join(lines)
+
+
+# Shared by everything that wasn't handed a Stats of its own.
+DISABLED = Stats(enabled=False)
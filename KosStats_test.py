@@ -0,0 +1,39 @@
+import unittest
+
+import KosStats
+
+
+class TestStats(unittest.TestCase):
+  def test_timer(self):
+    stats = KosStats.Stats()
+    with stats.timer('stage'):
+      pass
+    stats.record('stage', 0.3)
+    snapshot = stats.snapshot()['stages']['stage']
+    self.assertEquals(snapshot['count'], 2)
+    self.assertAlmostEquals(snapshot['max'], 0.3)
+    self.assertEquals(snapshot['p99'], 0.3)
+    self.assertTrue('stage' in stats.format())
+
+  def test_slower_than_buckets(self):
+    stats = KosStats.Stats()
+    stats.record('stage', 60.0)
+    self.assertEquals(stats.snapshot()['stages']['stage']['p50'], 60.0)
+
+  def test_disabled(self):
+    stats = KosStats.Stats(enabled=False)
+    with stats.timer('stage'):
+      pass
+    stats.record('stage', 0.3)
+    stats.increment('counter')
+    self.assertEquals(stats.snapshot(), {'stages': {}, 'counters': {}})
+
+  def test_counters(self):
+    stats = KosStats.Stats()
+    stats.increment('hit')
+    stats.increment('hit', 2)
+    self.assertEquals(stats.snapshot()['counters'], {'hit': 3})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,64 +1,257 @@
 #!/usr/bin/python
 
+"""Audits a character's contact standings against the KOS list.
+
+Usage: StandingsCheck.py [--state FILE] [--full] keyID vCode charID
+
+The result for every contact is saved to the state file. Later runs only
+re-check contacts that are new, changed standing or whose verdict has
+expired, and only print what changed, so the audit can run from cron.
+"""
+
 from evelink import api, char, corp, eve
+import argparse
 import ChatKosLookup
+import json
+import KosHttp
+import os
 import sys
+import tempfile
+import threading
+import time
 
 MAX_NPC_AGENT = 3020000
 
+# What an entity is, where its ID alone tells us.
+CHARACTER = 'character'
+CORP = 'corp'
+ALLIANCE = 'alliance'
+# (first ID, last ID + 1, kind) of the ranges handed out since 2010.
+# Older IDs are shared by all three kinds.
+ID_RANGES = (
+    (90000000, 98000000, CHARACTER),
+    (98000000, 99000000, CORP),
+    (99000000, 100000000, ALLIANCE),
+    (2100000000, 2147483648, CHARACTER),
+)
+# Progress is reported after this many contacts.
+PROGRESS_EVERY = 25
+
+REMOVE = 'remove'
+DEMOTE = 'demote'
+PROMOTE = 'promote'
+# Headings and markers of each kind of finding, in the order printed.
+FINDINGS = (
+    (REMOVE, 'Defunct and can be removed:', '?'),
+    (DEMOTE, 'KOS and should be < 0:', '-'),
+    (PROMOTE, 'Not KOS and should be >=0 or removed:', '+'),
+)
+
+
+def entity_kind(eid):
+  """Returns CHARACTER, CORP or ALLIANCE if eid's range shows it, else None."""
+  for (low, high, kind) in ID_RANGES:
+    if low <= eid < high:
+      return kind
+  return None
+
+
+def finding(standing, kos, valid):
+  """Returns REMOVE, DEMOTE or PROMOTE for a contact, or None if it's fine."""
+  if not valid:
+    return REMOVE
+  elif standing < 0 and (kos == False or kos == ChatKosLookup.NPC):
+    return PROMOTE
+  elif (standing >= 0 and
+        kos != None and kos != ChatKosLookup.NPC and kos != False):
+    return DEMOTE
+  return None
+
+
+def load_state(path):
+  """Returns the records saved by the last audit, or {} if there are none."""
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'rb') as f:
+    return json.load(f)
+
+
+def save_state(path, state):
+  # A name of its own, as audits run from cron can overlap.
+  handle, tmp = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(path)),
+      prefix=os.path.basename(path) + '.', suffix='.tmp')
+  try:
+    with os.fdopen(handle, 'wb') as f:
+      json.dump(state, f, indent=1, sort_keys=True)
+    # Windows won't rename over an existing file.
+    if os.path.exists(path):
+      os.remove(path)
+    os.rename(tmp, path)
+  except:
+    os.remove(tmp)
+    raise
+
+
 class StandingsChecker:
-  def __init__(self, keyID, vCode, char_id):
-    self.checker = ChatKosLookup.KosChecker()
+  def __init__(self, keyID, vCode, char_id,
+               max_workers=ChatKosLookup.DEFAULT_WORKERS, cache_file=None):
+    self.checker = ChatKosLookup.KosChecker(max_workers=max_workers,
+                                            cache_file=cache_file)
     self.cache = self.checker.cache
+    # IDs of the alliances still in existence, fetched once per audit.
+    self.alliance_ids = None
 
-    self.api = api.API(cache=self.cache, api_key=(keyID, vCode))
+    self.api = ChatKosLookup.PooledAPI(self.checker.http, cache=self.cache,
+                                       api_key=(keyID, vCode))
     self.corp = corp.Corp(api=self.api)
     self.eve = eve.EVE(api=self.api)
     self.char = char.Char(api=self.api, char_id=char_id)
 
-  def check(self):
-    contacts = self.char.contacts()
+  def check(self, state_file=None, full=False):
+    """Audits every contact list.
+
+    With a state_file, unchanged contacts are taken from the last run and
+    only the differences printed, unless full is set.
+    """
+    start = time.time()
+    state = load_state(state_file) if state_file else {}
+
+    # Audits wait behind any lookups someone is waiting for.
+    with KosHttp.priority(KosHttp.BULK):
+      contacts = self.char.contacts()
+      for (key, value) in contacts.items():
+        previous = None if full else state.get(key)
+        state[key] = self.check_internal(value, previous, title=key)
+    if state_file:
+      save_state(state_file, state)
+    print >>sys.stderr, 'Audited %d contacts in %.1fs' % (
+        sum(len(value) for value in contacts.values()), time.time() - start)
+
+  def alive_alliances(self):
+    if self.alliance_ids is None:
+      self.alliance_ids = set(self.eve.alliances().keys())
+    return self.alliance_ids
+
+  def check_internal(self, contacts, previous=None, title=None):
+    """Audits one contact list and prints the findings, after title if any.
 
-    for (key, value) in contacts.items():
-      print key
-      self.check_internal(value)
+    previous holds the records returned by the last audit of this list.
+    Given them, only new, changed or expired contacts are checked again,
+    and only findings that appeared or went away are printed.
 
-  def check_internal(self, contacts):
+    @returns: records for every contact, to pass in as previous next time.
+    """
     entities = [(row['id'], row['name'], row['standing'])
                 for row in contacts.values() if row['id'] > MAX_NPC_AGENT]
+    # The contact list already carries IDs, so later pilot checks made
+    # through this checker never need to resolve these names again.
+    self.checker.remember_character_ids(
+        dict((name, eid) for (eid, name, standing) in entities))
 
-    alive_alliances = self.eve.alliances().keys()
-
-    remove = {}
-    demote = {}
-    promote = {}
-    for (eid, name, standing) in entities:
-      kos = self.checker.koscheck_internal(name)
-      if (not eid in alive_alliances and
-          not self.valid_corp(eid) and not self.valid_char(eid)):
-        remove[name] = standing
-      elif standing < 0 and (kos == False or kos == ChatKosLookup.NPC):
-        promote[name] = standing
-      elif (standing >= 0 and
-            kos != None and kos != ChatKosLookup.NPC and kos != False):
-        demote[name] = standing
-    if remove:
-      print 'Defunct and can be removed:'
-      for (name, standing) in sorted(remove.items()):
-        print '%3d > [?]: %s' % (standing, name)
-      print ''
-    if demote:
-      print 'KOS and should be < 0:'
-      for (name, standing) in sorted(demote.items()):
-        print '%3d > [-]: %s' % (standing, name)
-      print ''
-    if promote:
-      print 'Not KOS and should be >=0 or removed:'
-      for (name, standing) in sorted(promote.items()):
-        print '%3d > [+]: %s' % (standing, name)
-      print ''
+    now = time.time()
+    old = previous or {}
+    stale = [entity for entity in entities
+             if self.needs_check(old.get(str(entity[0])), entity[2], now)]
+
+    if stale:
+      # Fetched up front so the workers don't all ask for it at once.
+      self.alive_alliances()
+    progress = Progress(len(stale))
+    def audit(entity):
+      result = self.audit_entity(entity)
+      progress.step()
+      return result
+    results = dict(zip(stale, self.checker.map(audit, stale)))
+
+    records = {}
+    for entity in entities:
+      (eid, name, standing) = entity
+      if entity in results:
+        (kos, valid) = results[entity]
+        records[str(eid)] = {'name': name, 'standing': standing, 'kos': kos,
+                             'valid': valid, 'checked': now}
+      else:
+        records[str(eid)] = old[str(eid)]
+
+    if previous is None:
+      self.print_findings(title, records)
+    else:
+      self.print_changes(title, old, records)
+    return records
+
+  def needs_check(self, record, standing, now):
+    """Whether a contact's saved record is missing or out of date."""
+    if record is None or record['standing'] != standing:
+      return True
+    ttl = self.checker.verdict_ttls[ChatKosLookup.verdict_class(record['kos'])]
+    return now - record['checked'] >= ttl
+
+  def print_findings(self, title, records):
+    if title is not None:
+      print title
+    for (kind, heading, marker) in FINDINGS:
+      found = sorted((r['name'], r['standing']) for r in records.values()
+                     if finding(r['standing'], r['kos'], r['valid']) == kind)
+      if found:
+        print heading
+        for (name, standing) in found:
+          print '%3d > [%s]: %s' % (standing, marker, name)
+        print ''
+    print '---'
+
+  def print_changes(self, title, old, records):
+    """Prints findings that are new since old, then those that went away."""
+    def findings(records):
+      return dict((eid, finding(r['standing'], r['kos'], r['valid']))
+                  for (eid, r) in records.iteritems())
+    before = findings(old)
+    after = findings(records)
+    lines = []
+    for (kind, heading, marker) in FINDINGS:
+      found = sorted((records[eid]['name'], records[eid]['standing'])
+                     for (eid, now_kind) in after.iteritems()
+                     if now_kind == kind and before.get(eid) != kind)
+      if found:
+        lines.append('New: ' + heading)
+        lines.extend('%3d > [%s]: %s' % (standing, marker, name)
+                     for (name, standing) in found)
+        lines.append('')
+    resolved = sorted((old[eid]['name'], old[eid]['standing'])
+                      for (eid, kind) in before.iteritems()
+                      if kind and after.get(eid) != kind)
+    if resolved:
+      lines.append('Resolved:')
+      lines.extend('%3d > [ ]: %s' % (standing, name)
+                   for (name, standing) in resolved)
+      lines.append('')
+    if not lines:
+      return
+    if title is not None:
+      print title
+    for line in lines:
+      print line
     print '---'
 
+  def audit_entity(self, entity):
+    """Returns (KOS reason, whether the entity still exists)."""
+    (eid, name, standing) = entity
+    # The record is trusted for a whole TTL, so ask the site itself rather
+    # than trust stale cache or index answers.
+    return (self.checker.koscheck_internal(name, fresh=True),
+            self.valid_entity(eid))
+
+  def valid_entity(self, eid):
+    kind = entity_kind(eid)
+    if kind == ALLIANCE:
+      return eid in self.alive_alliances()
+    if kind == CORP:
+      return self.valid_corp(eid)
+    if kind == CHARACTER:
+      return self.valid_char(eid)
+    return (eid in self.alive_alliances() or
+            self.valid_corp(eid) or self.valid_char(eid))
+
   def valid_corp(self, eid):
     try:
       ret = self.corp.corporation_sheet(corp_id=eid)
@@ -75,9 +268,39 @@ class StandingsChecker:
     except ValueError:
       return False
 
+
+class Progress:
+  """Prints how many of total contacts have been checked, to stderr."""
+
+  def __init__(self, total):
+    self.total = total
+    self.done = 0
+    self.lock = threading.Lock()
+
+  def step(self):
+    with self.lock:
+      self.done += 1
+      if self.done % PROGRESS_EVERY == 0 or self.done == self.total:
+        print >>sys.stderr, 'Checked %d/%d contacts' % (self.done, self.total)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('keyID')
+  parser.add_argument('vCode')
+  parser.add_argument('charID')
+  parser.add_argument('--state',
+                      help='results of earlier audits (default: %s)' %
+                      os.path.join(tempfile.gettempdir(),
+                                   'standings_<charID>.json'))
+  parser.add_argument('--full', action='store_true',
+                      help='re-check every contact and print every finding')
+  args = parser.parse_args()
+  state = args.state or os.path.join(tempfile.gettempdir(),
+                                     'standings_%s.json' % args.charID)
+  StandingsChecker(args.keyID, args.vCode, args.charID).check(state, args.full)
+
+
 if __name__ == '__main__':
-  if len(sys.argv) > 3:
-    StandingsChecker(sys.argv[1], sys.argv[2], sys.argv[3]).check()
-  else:
-    print ('Usage: %s keyID vCode' % sys.argv[0])
+  main()
 
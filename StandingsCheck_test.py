@@ -0,0 +1,172 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.append('evelink-api')
+
+from evelink import api
+import ChatKosLookup
+import StandingsCheck
+
+
+class FakeEve:
+  def __init__(self):
+    self.alliance_calls = 0
+    self.probed = []
+
+  def alliances(self):
+    self.alliance_calls += 1
+    return {99000001: {}, 1500000: {}}
+
+  def character_info_from_id(self, char_id):
+    self.probed.append(char_id)
+    if char_id == 90000002:
+      raise api.APIError(105, 'Invalid characterID.')
+    return {}
+
+
+class FakeCorp:
+  def __init__(self, probed):
+    self.probed = probed
+
+  def corporation_sheet(self, corp_id):
+    self.probed.append(corp_id)
+    return {'ceo': {'id': 0 if corp_id == 98000002 else 1}}
+
+
+KOS = {'Bad Pilot': 'pilot: Bad Pilot', 'Npc Pilot': ChatKosLookup.NPC}
+
+
+class TestStandingsChecker(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.checker = StandingsCheck.StandingsChecker(
+        1, 'vcode', 2, cache_file=os.path.join(self.tmpdir, 'koscheck'))
+    self.checker.eve = FakeEve()
+    self.checker.corp = FakeCorp(self.checker.eve.probed)
+    self.checker.checker.koscheck_internal = self.koscheck_internal
+    self.fresh = []
+
+  def koscheck_internal(self, name, fresh=False):
+    self.fresh.append(fresh)
+    return KOS.get(name)
+
+  def test_entity_kind(self):
+    self.assertEquals(StandingsCheck.entity_kind(90000001),
+                      StandingsCheck.CHARACTER)
+    self.assertEquals(StandingsCheck.entity_kind(98000001),
+                      StandingsCheck.CORP)
+    self.assertEquals(StandingsCheck.entity_kind(99000001),
+                      StandingsCheck.ALLIANCE)
+    self.assertEquals(StandingsCheck.entity_kind(2112000000),
+                      StandingsCheck.CHARACTER)
+    self.assertEquals(StandingsCheck.entity_kind(1500000), None)
+
+  def audit(self, rows, previous=None):
+    contacts = dict((eid, {'id': eid, 'name': name, 'standing': standing})
+                    for (eid, name, standing) in rows)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = StringIO.StringIO()
+    sys.stderr = StringIO.StringIO()
+    try:
+      self.records = self.checker.check_internal(contacts, previous)
+      return sys.stdout.getvalue()
+    finally:
+      sys.stdout, sys.stderr = stdout, stderr
+
+  def test_audit(self):
+    output = self.audit([
+        (90000001, 'Bad Pilot', 5),
+        (90000002, 'Gone Pilot', 5),
+        (90000003, 'Npc Pilot', -10),
+        (98000002, 'Closed Corp', 0),
+        (99000001, 'Live Alliance', 0),
+        (99000002, 'Dead Alliance', -5),
+        (1500000, 'Old Alliance', 10),
+    ])
+    self.assertEquals(output.splitlines(), [
+        'Defunct and can be removed:',
+        '  0 > [?]: Closed Corp',
+        ' -5 > [?]: Dead Alliance',
+        '  5 > [?]: Gone Pilot',
+        '',
+        'KOS and should be < 0:',
+        '  5 > [-]: Bad Pilot',
+        '',
+        'Not KOS and should be >=0 or removed:',
+        '-10 > [+]: Npc Pilot',
+        '',
+        '---'])
+    # Alliances are never probed, the rest only as the kind they must be.
+    self.assertEquals(sorted(self.checker.eve.probed),
+                      [90000001, 90000002, 90000003, 98000002])
+
+  def test_alliances_fetched_once(self):
+    self.audit([(99000001, 'Live Alliance', 0)])
+    self.audit([(99000002, 'Dead Alliance', 0)])
+    self.assertEquals(self.checker.eve.alliance_calls, 1)
+
+  def test_incremental(self):
+    rows = [(90000001, 'Bad Pilot', 5), (90000003, 'Npc Pilot', 0),
+            (90000004, 'Fine Pilot', 0)]
+    self.audit(rows)
+    self.checker.eve.probed = []
+    self.assertEquals(self.audit(rows, self.records), '')
+    self.assertEquals(self.checker.eve.probed, [])
+
+    output = self.audit([(90000001, 'Bad Pilot', -5),
+                         (90000003, 'Npc Pilot', -5),
+                         (90000005, 'New Pilot', 0)], self.records)
+    self.assertEquals(output.splitlines(), [
+        'New: Not KOS and should be >=0 or removed:',
+        ' -5 > [+]: Npc Pilot',
+        '',
+        'Resolved:',
+        '  5 > [ ]: Bad Pilot',
+        '',
+        '---'])
+    self.assertEquals(sorted(self.checker.eve.probed),
+                      [90000001, 90000003, 90000005])
+
+  def test_expired_rechecked(self):
+    self.audit([(90000004, 'Fine Pilot', 0)])
+    self.records['90000004']['checked'] -= (
+        self.checker.checker.verdict_ttls[ChatKosLookup.NOTKOS])
+    self.checker.eve.probed = []
+    self.audit([(90000004, 'Fine Pilot', 0)], self.records)
+    self.assertEquals(self.checker.eve.probed, [90000004])
+    # Not answered from the cache the expired record came from.
+    self.assertEquals(self.fresh, [True, True])
+
+  def test_state_file(self):
+    path = tempfile.mktemp()
+    try:
+      StandingsCheck.save_state(path, {'personal': {'1': {'name': 'A'}}})
+      StandingsCheck.save_state(path, {'personal': {'2': {'name': 'B'}}})
+      self.assertEquals(StandingsCheck.load_state(path),
+                        {'personal': {'2': {'name': 'B'}}})
+    finally:
+      os.unlink(path)
+    self.assertEquals(StandingsCheck.load_state(path), {})
+
+  def test_state_file_no_tmp_left(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmpdir, 'standings.json')
+      StandingsCheck.save_state(path, {'personal': {}})
+      self.assertRaises(TypeError, StandingsCheck.save_state, path,
+                        {'personal': object()})
+      self.assertEquals(os.listdir(tmpdir), ['standings.json'])
+      self.assertEquals(StandingsCheck.load_state(path), {'personal': {}})
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()